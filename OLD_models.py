@@ -2,24 +2,36 @@
 Database models
 """
 from django.conf import settings
-from django.db import models,transaction
+from django.db import models,transaction,IntegrityError
 from django.contrib.auth.models import (
     AbstractBaseUser,
     BaseUserManager,
     PermissionsMixin,
     )
 from django.utils.timezone import now
-import os
+from django.core.validators import MinValueValidator
+import logging
 from dotenv import load_dotenv
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from utils import utils_encryption
+from utils import utils_encryption, dice_rolls, dice_table, metrics, seed_keys, seed_cache
+from functools import lru_cache
 from secrets import token_hex
+from decimal import Decimal
+from datetime import timedelta
+import random
+import time
 
 # Load the .env file
 load_dotenv()
-print()
-SEEDS_KEYWORD =   os.environ['SEEDS_KEY']
+logger = logging.getLogger(__name__)
+BANKROLL_SHARDS = getattr(settings, 'BANKROLL_SHARDS', 16) #Number of shard rows per coin for the casino bankroll
+FLASH_BET_PAGES_CACHE_SIZE = getattr(settings, 'FLASH_BET_PAGES_CACHE_SIZE', 256) #Pages of regenerated flash bet rolls kept in memory
+BET_QUANTUM = Decimal('0.00000001') #8 decimals of the amounts
+COIN_REGISTRY_TTL = getattr(settings, 'COIN_REGISTRY_TTL', 60) #seconds the active coins are cached in each process
+SEED_POOL_LOW_WATER = getattr(settings, 'SEED_POOL_LOW_WATER', 1000) #Pre-generated server seeds: refill below this
+SEED_POOL_TARGET = getattr(settings, 'SEED_POOL_TARGET', 5000) #... up to this
+FLASH_BET_IN_FLIGHT_TTL = getattr(settings, 'FLASH_BET_IN_FLIGHT_TTL', 3600) #seconds an unsettled flash bet blocks the seed reveal (lost process)
 """
 USER MODELS: profiles, logins 
 """
@@ -94,6 +106,8 @@ class Game_Trx_historic(Bet_Model):
     
     
     rolled_dice = models.DecimalField('Result_Dice_Roll', max_digits=5,decimal_places=2 , default=0) #ROLLED VALUE WITH PROVABLY FAIR STEPS;
+    nonce = models.PositiveIntegerField(default=0) #Nonce of the seed used for this roll
+    flash_bet = models.ForeignKey('FlashBet', on_delete=models.CASCADE, null=True, blank=True) #Flash bet of this roll (seed identity), if any
     #payout_multiplier = models.DecimalField('User_Choice_Roll', max_digits=8,decimal_places=5 , default=0) 
     is_winner = models.BooleanField(default=False)
 
@@ -102,16 +116,68 @@ class Game_Trx_historic(Bet_Model):
         return self.description
 #Class for Custom Dice Strategies saved by user
 class Dice_Custom_Strategies(Bet_Model):
-    """Represent saved strats for each user"""
+    """Represent saved strats for each user
+
+    bet_amount is the base bet; after each roll the on win / on loss rule gives the next bet
+    (keep it, reset it to the base bet or multiply it). The run stops after number_of_rolls,
+    or when the net profit reaches -stop_loss or take_profit.
+    Executed server side by utils/flash_bet_engine.StrategyEngine.
+    """
+    ACTION_KEEP = 'KEEP'
+    ACTION_RESET = 'RESET'
+    ACTION_MULTIPLY = 'MULTIPLY'
+    ACTION_CHOICES = [
+        (ACTION_KEEP, 'Keep bet'),
+        (ACTION_RESET, 'Reset to base bet'),
+        (ACTION_MULTIPLY, 'Multiply bet'),
+    ]
         
     user = models.ForeignKey( 
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
     )
     title_strategy = models.CharField('Title_Strategy', max_length=50 ,default='Strat') 
+    bet_amount = models.DecimalField('Bet_Amount', max_digits=18, decimal_places=8, default=0,
+                                     validators=[MinValueValidator(BET_QUANTUM)]) #base bet
     number_of_rolls =  models.PositiveIntegerField(default=0)
-    #TODO
-    #Missing extra configuration rules (on win, on loss resets for example)...
+    on_win_action = models.CharField('On_Win', max_length=10, choices=ACTION_CHOICES, default=ACTION_RESET)
+    on_win_multiplier = models.DecimalField('On_Win_Multiplier', max_digits=10, decimal_places=4, default=1,
+                                            validators=[MinValueValidator(Decimal('0.0001'))])
+    on_loss_action = models.CharField('On_Loss', max_length=10, choices=ACTION_CHOICES, default=ACTION_KEEP)
+    on_loss_multiplier = models.DecimalField('On_Loss_Multiplier', max_digits=10, decimal_places=4, default=1,
+                                             validators=[MinValueValidator(Decimal('0.0001'))])
+    stop_loss = models.DecimalField('Stop_Loss', max_digits=18, decimal_places=8, null=True, blank=True,
+                                    validators=[MinValueValidator(0)]) #stop when net profit <= -stop_loss
+    take_profit = models.DecimalField('Take_Profit', max_digits=18, decimal_places=8, null=True, blank=True,
+                                      validators=[MinValueValidator(0)]) #stop when net profit >= take_profit
+
+    def next_bet(self, bet, won):
+        """Bet of the next roll after a roll of `bet` (won or lost)."""
+        action, multiplier = (self.on_win_action, self.on_win_multiplier) if won else (self.on_loss_action, self.on_loss_multiplier)
+        if action == self.ACTION_RESET:
+            return self.bet_amount
+        if action == self.ACTION_MULTIPLY:
+            return (bet * multiplier).quantize(BET_QUANTUM)
+        return bet
+
+    def stop_reason(self, net_profit):
+        """'stop_loss' / 'take_profit' when a limit is reached, None otherwise."""
+        if self.stop_loss is not None and net_profit <= -self.stop_loss:
+            return 'stop_loss'
+        if self.take_profit is not None and net_profit >= self.take_profit:
+            return 'take_profit'
+        return None
+
+    def bet_data(self, number_of_rolls=None):
+        """Flash bet data of a run of this strategy (base bet)."""
+        return {
+            'number_of_bets': self.number_of_rolls if number_of_rolls is None else number_of_rolls,
+            'bet_amount': self.bet_amount,
+            'coin_ticker': self.coin_ticker,
+            'user_winrate_choice': self.user_winrate_choice,
+            'is_roll_under': self.is_roll_under,
+            'description': 'Strategy: ' + self.title_strategy,
+        }
 
 class FlashBet(Bet_Model):
     user = models.ForeignKey( 
@@ -121,8 +187,108 @@ class FlashBet(Bet_Model):
     
     number_of_bets = models.PositiveIntegerField()
 
+    #Seed identity & nonce range consumed by this flash bet => every roll can be regenerated on demand (no roll stored)
+    server_seed = models.CharField(max_length=300, default='') #encrypted, as stored in Seed when the bet was made
+    hashed_server_seed = models.CharField(max_length=300, default='')
+    client_seed = models.CharField(max_length=300, default='')
+    nonce_start = models.PositiveIntegerField(default=0) #rolls use nonces [nonce_start, nonce_start + number_of_bets)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-id']), #keyset pagination of the history (utils/pagination.py)
+        ]
+
+    def expand_rolls(self, page, page_size):
+        """Regenerate the rolls of one page of this flash bet: list of (nonce, roll, is_winner).
+
+        ValueError for the flash bets saved without their seeds (before the seeds were stored).
+        """
+        if not self.server_seed:
+            raise ValueError('The seeds of this flash bet were not stored, its rolls cannot be regenerated')
+        first = page * page_size
+        count = max(0, min(page_size, self.number_of_bets - first))
+        dice_params = dice_table.get_dice_setup(self.user_winrate_choice, self.is_roll_under)
+        return expand_rolls_page(self.server_seed, self.client_seed, self.nonce_start + first, count,
+                                 dice_params.min_range, dice_params.max_range)
+
+
+@lru_cache(maxsize=FLASH_BET_PAGES_CACHE_SIZE)
+def expand_rolls_page(server_seed, client_seed, nonce_start, count, min_range, max_range):
+    """Roll `count` nonces of an (encrypted) server seed; LRU cache of the recently expanded pages."""
+    if count <= 0:
+        return ()
+    rolls = dice_rolls.roll_range(seed_keys.decrypt(server_seed), client_seed, nonce_start, count)
+    mask = dice_rolls.win_mask(min_range, max_range)
+    return tuple((nonce, dice_rolls.hundredths_to_roll(roll), bool(mask[roll]))
+                 for nonce, roll in enumerate(rolls, nonce_start))
+
+
+class FlashBetJob(models.Model):
+    """Flash bet too big to run in the request: executed by the flash bet workers (utils/flash_bet_jobs.py)."""
+    STATUS_PENDING = 'PENDING'
+    STATUS_RUNNING = 'RUNNING'
+    STATUS_DONE = 'DONE'
+    STATUS_FAILED = 'FAILED'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    user = models.ForeignKey( 
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+    )
+    status = models.CharField('Status', max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    bet_data = models.JSONField() #validated data of the flash bet request
+    result = models.JSONField(null=True, blank=True) #winnings, losses, net_profit...
+    error = models.TextField(blank=True)
+    flash_bet = models.ForeignKey(FlashBet, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField('Date_Created', default=now)
+    started_at = models.DateTimeField('Date_Started', null=True, blank=True)
+    heartbeat_at = models.DateTimeField('Last_Heartbeat', null=True, blank=True) #lease of the running worker
+    attempt = models.PositiveIntegerField(default=0) #claims of the job: only the current one can complete it
+    finished_at = models.DateTimeField('Date_Finished', null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id']),
+            models.Index(fields=['user', 'status']),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    """Result of a request sent with an Idempotency-Key header (utils/idempotency.py): replayed on retries."""
+    STATUS_IN_PROGRESS = 'IN_PROGRESS'
+    STATUS_DONE = 'DONE'
+    STATUS_CHOICES = [
+        (STATUS_IN_PROGRESS, 'In progress'),
+        (STATUS_DONE, 'Done'),
+    ]
+
+    user = models.ForeignKey( 
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+    )
+    key = models.CharField('Key', max_length=100)
+    request_hash = models.CharField('Request_Hash', max_length=64) #same key with another body is refused
+    status = models.CharField('Status', max_length=12, choices=STATUS_CHOICES, default=STATUS_IN_PROGRESS)
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.BinaryField(null=True, blank=True) #rendered JSON, replayed byte for byte
+    created_at = models.DateTimeField('Date_Created', default=now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_user_idempotency_key'),
+        ]
+        indexes = [
+            models.Index(fields=['created_at']), #TTL sweep
+        ]
+
 
 from hashlib import sha256, sha512
+HASH_PLACEHOLDER = "HASH" #Default of hashed_server_seed_for_user before the seed is hashed
 #Class seed for Provably fair part
 class Seed(models.Model):
     """Represent seed for provably random number generation. 
@@ -135,7 +301,7 @@ class Seed(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE) #One to one field due to the fact that a user can only have a sigle SEED setup
     client_seed = models.CharField(max_length=300,default="Seed") #Based on input from user or random elements from him;
     server_seed = models.CharField(max_length=300,default= "ServerSeed")#token_hex(32))
-    hashed_server_seed_for_user = models.CharField(max_length=300,default="HASH")
+    hashed_server_seed_for_user = models.CharField(max_length=300,default=HASH_PLACEHOLDER)
     visible = models.BooleanField(default=False) #If the server seed is visible/revealed by user already
     nonce = models.PositiveIntegerField(default=0)
     
@@ -149,39 +315,118 @@ class Seed(models.Model):
         else:
             return 'Hidden'
 
+    @classmethod
+    def load_for_user(cls, user, lock=False):
+        """Seed of the user with his profile (seed.user.profile_user) in a single query.
+
+        lock=True: both rows are locked (SELECT ... FOR UPDATE) until the end of the transaction.
+        None if the user has no seed/profile.
+        """
+        rows = cls.objects.select_related('user__profile_user').filter(user=user, user__profile_user__isnull=False)
+        if lock:
+            rows = rows.select_for_update(of=('self', 'user__profile_user'))
+        try:
+            return rows.get()
+        except cls.DoesNotExist:
+            return None
+
+    PUBLIC_FIELDS = ('hashed_server_seed_for_user', 'client_seed', 'nonce', 'visible')
+
+    @classmethod
+    def public_state(cls, user_id):
+        """Public seed state of a user (polled by the client), read through the seed cache. None if no seed."""
+        cache = seed_cache.get_seed_cache()
+        state = cache.get(user_id)
+        if state is None:
+            generation = cache.generation(user_id) #before the read: an invalidation meanwhile voids the entry
+            state = cls.objects.filter(user_id=user_id).values(*cls.PUBLIC_FIELDS).first()
+            if state is not None:
+                cache.set(user_id, state, generation)
+        return state
+
+    def invalidate_public_state(self):
+        """Drop the cached public state now and after the commit (a read in between would cache the old row)."""
+        cache = seed_cache.get_seed_cache()
+        cache.delete(self.user_id)
+        transaction.on_commit(lambda: cache.delete(self.user_id))
+
     def increment_nonce(self):
-        self.nonce += 1
-        self.save(update_fields=['nonce'])
+        self.reserve_nonces(1)
+
+    def reserve_nonces(self, count):
+        """Atomically claim `count` consecutive nonces for this seed and return the first one.
+
+        One conditional UPDATE (compare and swap on nonce & seed hash), so two
+        concurrent flash bets of the same user can never get overlapping nonces.
+        If another request moved the nonce first we reload it and retry;
+        if the server seed was rotated meanwhile the reservation is refused.
+        (The hash identifies the seed: the encrypted value changes with a key rotation, not the seed.)
+        """
+        if count < 0:
+            raise ValueError('Invalid nonce count')
+        while True:
+            nonce_start = self.nonce
+            updated = Seed.objects.filter(pk=self.pk, nonce=nonce_start, hashed_server_seed_for_user=self.hashed_server_seed_for_user).update(
+                nonce=models.F('nonce') + count)
+            if updated:
+                self.nonce = nonce_start + count
+                self.invalidate_public_state()
+                return nonce_start
+            current = Seed.objects.filter(pk=self.pk).values('nonce', 'hashed_server_seed_for_user').first()
+            if current is None or current['hashed_server_seed_for_user'] != self.hashed_server_seed_for_user:
+                raise ValueError('Server seed changed, nonces not reserved')
+            self.nonce = current['nonce']
+
+    def begin_flash_bet(self):
+        """Lease marking a flash bet in flight on this seed until end_flash_bet(lease id); returns its id.
+
+        One lease per flash bet, each expiring on its own after FLASH_BET_IN_FLIGHT_TTL seconds,
+        so a lost process only blocks the seed until its own lease expires (expired ones are deleted here).
+        """
+        Flash_Bet_Lease.objects.filter(seed=self, expires_at__lte=now()).delete()
+        return Flash_Bet_Lease.objects.create(seed=self, expires_at=now() + timedelta(seconds=FLASH_BET_IN_FLIGHT_TTL)).pk
+
+    def end_flash_bet(self, lease_id):
+        """The flash bet of this lease is over (settled or not)."""
+        Flash_Bet_Lease.objects.filter(pk=lease_id).delete()
+
+    def flash_bet_in_flight(self):
+        """True while a flash bet has reserved nonces of this seed without being settled (check it on a locked seed):
+        revealing or changing the server seed then would show the rolls before their settlement.
+        """
+        return Flash_Bet_Lease.objects.filter(seed=self, expires_at__gt=now()).exists()
     
     def modify_server_seed(self, new_ss=None):
         if new_ss != None:
             self.server_seed = new_ss 
+            #hash it before:
+            self.hashed_server_seed_for_user = utils_encryption.hash_input_SHA256(self.server_seed)#self.hash_it_without_decrypt()
+            #encrypt server_seed:
+            self.server_seed = seed_keys.encrypt(self.server_seed)
         else:
-            self.server_seed = token_hex(32)
-            
-            
-        #hash it before:
-        self.hashed_server_seed_for_user = utils_encryption.hash_input_SHA256(self.server_seed)#self.hash_it_without_decrypt()
-        #encrypt server_seed:
-        self.server_seed = utils_encryption.encrypt(self.server_seed, SEEDS_KEYWORD)
+            #New random seed, already encrypted & hashed, from the pool
+            self.server_seed, self.hashed_server_seed_for_user = ServerSeedPool.claim()
+
         self.visible = False
         self.nonce = 0 #Reset nonce
         self.save(update_fields=['server_seed','visible','nonce','hashed_server_seed_for_user'])
+        self.invalidate_public_state()
         
     def modify_client_seed(self,new_cs):
         self.client_seed = new_cs 
         self.save(update_fields=['client_seed'])
+        self.invalidate_public_state()
         
     def decrypt_server_seed(self):
-        print("uhzeuhzeu",SEEDS_KEYWORD, self.server_seed)
-        print()
-        return  utils_encryption.decrypt(self.server_seed, SEEDS_KEYWORD)
+        with metrics.span('seed_decrypt'):
+            return  seed_keys.decrypt(self.server_seed)
     
     def reveal_server_seed(self):
         
         original_seed = self.decrypt_server_seed()
         self.visible = True 
         self.save(update_fields=['visible'])
+        self.invalidate_public_state()
     
         return original_seed
     
@@ -189,28 +434,83 @@ class Seed(models.Model):
     #    """ Initialize starting server seed when user is created and their profile """
     #    self.server_seed = token_hex(32)
     def hash_server_seed(self):
-        """Get the hash of the server _seed (original)
-        1- We have to decrypt the seed stored in the DB ; 
-        2 - Hash it and return (this is what we show to the user until he reveals the server seed )
+        """Get the hash of the server _seed (original) (this is what we show to the user until he reveals the server seed )
+        It is stored when the seed is set (signal & modify_server_seed), so no decryption here;
+        only old rows without it are decrypted & hashed once, then the hash is stored.
         """
+        if self.hashed_server_seed_for_user and self.hashed_server_seed_for_user != HASH_PLACEHOLDER:
+            return self.hashed_server_seed_for_user
+
         original_seed = self.decrypt_server_seed()
         #server_seed_hash_object = sha256(self.server_seed.encode())
         server_seed_hash_object = sha256(original_seed.encode())
-        server_seed_hash = server_seed_hash_object.hexdigest()
-        
-        return server_seed_hash
+        self.hashed_server_seed_for_user = server_seed_hash_object.hexdigest()
+        self.save(update_fields=['hashed_server_seed_for_user'])
+        self.invalidate_public_state()
+        return self.hashed_server_seed_for_user
+
+class Flash_Bet_Lease(models.Model):
+    """Flash bet with reserved nonces of a seed, not settled yet (Seed.begin_flash_bet / end_flash_bet)."""
+    seed = models.ForeignKey(Seed, on_delete=models.CASCADE, related_name='flash_bet_leases')
+    expires_at = models.DateTimeField('Date_Expires')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['seed', 'expires_at']),
+        ]
+
+
+class ServerSeedPool(models.Model):
+    """Ready-made server seeds (encrypted seed + its hash) for signups and seed rotations.
+
+    Kept above SEED_POOL_LOW_WATER by the refill_seed_pool command (background worker),
+    so the token generation, hashing and encryption are not done in the user requests.
+    """
+    server_seed = models.CharField(max_length=300) #encrypted
+    hashed_server_seed = models.CharField(max_length=300)
+    created_at = models.DateTimeField('Date_Created', default=now)
+
+    @staticmethod
+    def generate():
+        """New random server seed: (encrypted seed, hash)."""
+        tmp_server_seed = token_hex(32)
+        return seed_keys.encrypt(tmp_server_seed), utils_encryption.hash_input_SHA256(tmp_server_seed)
+
+    @classmethod
+    def claim(cls):
+        """Take one seed out of the pool: (encrypted seed, hash). Generated on the fly if the pool is empty."""
+        for _ in range(3):
+            with transaction.atomic():
+                entry = cls.objects.select_for_update(skip_locked=True).order_by('id').first()
+                if entry is None:
+                    break
+                #Only the worker that deletes the row gets the seed (no lock on some backends)
+                deleted, _ = cls.objects.filter(pk=entry.pk).delete()
+                if deleted:
+                    return entry.server_seed, entry.hashed_server_seed
+        return cls.generate()
+
+    @classmethod
+    def refill(cls, low_water=None, target=None, batch_size=500):
+        """Fill the pool up to `target` seeds when it is below `low_water`; return the number of seeds added."""
+        low_water = SEED_POOL_LOW_WATER if low_water is None else low_water
+        target = SEED_POOL_TARGET if target is None else target
+        depth = cls.objects.count()
+        if depth >= low_water:
+            return 0
+        missing = target - depth
+        for start in range(0, missing, batch_size):
+            cls.objects.bulk_create([cls(server_seed=enc, hashed_server_seed=hashed)
+                                     for enc, hashed in (cls.generate() for _ in range(min(batch_size, missing - start)))])
+        return missing
+
 
 #Create a matching entry in SEED Table everytime a user is created
 @receiver(post_save, sender=User)
 def update_seed_signal(sender, instance, created, **kwargs):
     if created:
-        s = Seed.objects.create(user=instance)
-        tmp_server_seed = token_hex(32)
-        #print("S:,",s.server_seed)
-        hashed_field = utils_encryption.hash_input_SHA256(tmp_server_seed)
-        s.hashed_server_seed_for_user = hashed_field
-        s.server_seed = utils_encryption.encrypt(tmp_server_seed, SEEDS_KEYWORD)
-        s.save(update_fields=['hashed_server_seed_for_user','server_seed'])
+        server_seed, hashed_field = ServerSeedPool.claim()
+        Seed.objects.create(user=instance, server_seed=server_seed, hashed_server_seed_for_user=hashed_field)
                 
     #instance.profile.save()
 
@@ -224,116 +524,307 @@ def update_seed_signal(sender, instance, created, **kwargs):
 PROFILES: keep track of funds for each blockchain & currencies & Settings
 """
 
+class Coin(models.Model):
+    """Ticker registry: the coins that can be played & deposited (PLAY, ETH, BTC...).
+
+    Adding a coin is a new row here, no schema migration.
+    """
+    ticker = models.CharField('Coin_Ticker', max_length=20, primary_key=True)
+    name = models.CharField('Name', max_length=50, blank=True)
+    is_active = models.BooleanField(default=True)
+    default_user_amount = models.DecimalField('Default_Amount', max_digits=18, decimal_places=8, default=0) #funds of a new profile (PLAY: 100)
+
+    _registry = {'expires': 0, 'coins': {}} #process cache of the active coins
+
+    @classmethod
+    def registry(cls):
+        """{ticker: default_user_amount} of the active coins (cached COIN_REGISTRY_TTL seconds)."""
+        if time.monotonic() >= cls._registry['expires']:
+            cls._registry = {
+                'expires': time.monotonic() + COIN_REGISTRY_TTL,
+                'coins': dict(cls.objects.filter(is_active=True).values_list('ticker', 'default_user_amount')),
+            }
+        return cls._registry['coins']
+
+    @classmethod
+    def check_ticker(cls, coin_ticker):
+        if coin_ticker not in cls.registry():
+            raise ValueError('Bad ticker for bet')
+        return coin_ticker
+
+    def __str__(self):
+        return self.ticker
+
+
+class Coin_Balance(models.Model):
+    """Balance of one coin for one owner (user profile or casino bankroll).
+
+    One row per (owner, coin): a bet only writes the row of its coin.
+    """
+    OWNER_PROFILE = 'PROFILE'
+    OWNER_BANKROLL = 'BANKROLL'
+    OWNER_CHOICES = [
+        (OWNER_PROFILE, 'Profile'),
+        (OWNER_BANKROLL, 'Bankroll'),
+    ]
+
+    owner_type = models.CharField('Owner_Type', max_length=10, choices=OWNER_CHOICES)
+    owner_id = models.PositiveBigIntegerField('Owner_Id')
+    coin = models.ForeignKey(Coin, on_delete=models.PROTECT, db_column='coin_ticker')
+    amount = models.DecimalField('Amount', max_digits=18, decimal_places=8, default=0)
+
+    class Meta:
+        constraints = [
+            #Also the index of the point lookups (owner_type, owner_id, coin)
+            models.UniqueConstraint(fields=['owner_type', 'owner_id', 'coin'], name='unique_owner_coin_balance'),
+        ]
+
+    def __str__(self):
+        return f'{self.owner_type} {self.owner_id}: {self.amount} {self.coin_id}'
+
+
 class Account_balances(models.Model):
-    PLAY_amount = models.DecimalField('AmountPLAY', max_digits=18, decimal_places=8, default=100)
-    ETH_amount = models.DecimalField('AmountBTC', max_digits=18, decimal_places=8, default=0)
-    BTC_amount = models.DecimalField('AmountETH', max_digits=18, decimal_places=8, default=0)
+    """Owner of coin balances (rows of Coin_Balance), same code path for the users & the casino."""
+    BALANCE_OWNER_TYPE = None
 
     class Meta:
         abstract = True
 
+    def _balances(self):
+        return Coin_Balance.objects.filter(owner_type=self.BALANCE_OWNER_TYPE, owner_id=self.pk)
+
+    def get_balance(self, coin_ticker, lock=False):
+        """Funds of one coin (0 if never funded). lock=True: the balance row stays locked until the end of the transaction."""
+        Coin.check_ticker(coin_ticker)
+        rows = self._balances().filter(coin_id=coin_ticker)
+        if lock:
+            rows = rows.select_for_update()
+        return rows.values_list('amount', flat=True).first() or Decimal(0)
+
+    def get_balances(self):
+        """{ticker: amount} of every funded coin."""
+        return dict(self._balances().values_list('coin_id', 'amount'))
+
+    def add_balance(self, coin_ticker, delta, guarded=True):
+        """Single column atomic update of one coin: UPDATE ... SET amount = amount + delta [WHERE amount + delta >= 0].
+
+        ValueError if the guard fails (not enough funds). The row is created on the first credit.
+        """
+        Coin.check_ticker(coin_ticker)
+        rows = self._balances().filter(coin_id=coin_ticker)
+        guarded_rows = rows.filter(amount__gte=-delta) if guarded else rows
+        if guarded_rows.update(amount=models.F('amount') + delta):
+            return
+        if rows.exists() or (guarded and delta < 0):
+            raise ValueError('Not enough funds')
+        try:
+            with transaction.atomic():
+                Coin_Balance.objects.create(owner_type=self.BALANCE_OWNER_TYPE, owner_id=self.pk,
+                                            coin_id=coin_ticker, amount=delta)
+        except IntegrityError:
+            #Created by another worker in the meantime
+            if not guarded_rows.update(amount=models.F('amount') + delta):
+                raise ValueError('Not enough funds')
+
 
 
 #CASINO BANKROLL ACCOUNT; 
 class Casino_Bankroll(Account_balances):
+    """Casino bankroll.
+
+    Its Coin_Balance rows only hold the compacted balance; wins and losses of the
+    users go to Casino_Bankroll_Shard rows (F() increments on a random shard)
+    so bettors don't all serialize on a single row.
+    Real balance = balance + sum of the shards, see get_total().
+    """
+    BALANCE_OWNER_TYPE = Coin_Balance.OWNER_BANKROLL
+
     is_bank_acc = models.BooleanField(default=True)
     label = models.CharField('Label', max_length=100 ,default='Bankroll')  # Ticker
-    
+
+    _handle = None #process wide bankroll, see get_cached()
+
+    @classmethod
+    def get_cached(cls):
+        """The casino bankroll, loaded once per process.
+
+        Only its pk is used by the bets (shard increments), so the handle never goes stale.
+        DoesNotExist if there is no bankroll row: bets must not settle without their casino side.
+        """
+        if cls._handle is None:
+            handle = cls.objects.order_by('pk').first()
+            if handle is None:
+                logger.error("No casino bankroll row: bets refused")
+                raise cls.DoesNotExist('No casino bankroll')
+            cls._handle = handle
+        return cls._handle
+
+    def add_funds(self, amount, coin_ticker):
+        """Add (negative amount => remove) funds to the bankroll through one of its shards."""
+        Casino_Bankroll_Shard.increment(self, coin_ticker, amount)
+
+    def get_total(self, coin_ticker):
+        """Bankroll balance for a coin: compacted balance + pending shards.
+
+        Both are read by one SELECT (two subqueries, same snapshot), so a compaction
+        committing in between can't count the folded shards twice or not at all.
+        """
+        Coin.check_ticker(coin_ticker)
+        pending = (Casino_Bankroll_Shard.objects.filter(bankroll=models.OuterRef('pk'), coin_ticker=coin_ticker)
+                   .order_by().values('bankroll').annotate(total=models.Sum('amount')).values('total'))
+        compacted, pending = Casino_Bankroll.objects.filter(pk=self.pk).annotate(
+            compacted=models.Subquery(self._balances().filter(coin_id=coin_ticker).values('amount')[:1]),
+            pending=models.Subquery(pending),
+        ).values_list('compacted', 'pending').get()
+        return (compacted or Decimal(0)) + (pending or 0)
+
+    def compact_shards(self, coin_ticker=None):
+        """Fold the shards back into the bankroll balances (periodic job: compact_bankroll command)."""
+        tickers = [coin_ticker] if coin_ticker else self.shards.values_list('coin_ticker', flat=True).distinct()
+        for ticker in list(tickers):
+            with transaction.atomic():
+                #Lock the shards of this coin: concurrent increments wait until they are reset
+                shards = list(self.shards.select_for_update().filter(coin_ticker=ticker))
+                delta = sum(shard.amount for shard in shards)
+                if delta:
+                    self.add_balance(ticker, delta, guarded=False) #the casino can be in the red on a coin
+                    self.shards.filter(pk__in=[shard.pk for shard in shards]).update(amount=0)
+
+
+class Casino_Bankroll_Shard(models.Model):
+    """One slice of the pending bankroll balance for a coin."""
+    bankroll = models.ForeignKey(Casino_Bankroll, on_delete=models.CASCADE, related_name='shards')
+    coin_ticker = models.CharField('Coin_Ticker', max_length=20)
+    shard = models.PositiveSmallIntegerField()
+    amount = models.DecimalField('Amount', max_digits=18, decimal_places=8, default=0) #can be negative (payouts)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['bankroll', 'coin_ticker', 'shard'], name='unique_bankroll_shard'),
+        ]
+
+    @classmethod
+    def increment(cls, bankroll, coin_ticker, amount):
+        """Atomic F() increment of a random shard (created on first use)."""
+        Coin.check_ticker(coin_ticker)
+        shard = random.randrange(BANKROLL_SHARDS)
+        rows = cls.objects.filter(bankroll=bankroll, coin_ticker=coin_ticker, shard=shard)
+        if rows.update(amount=models.F('amount') + amount):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(bankroll=bankroll, coin_ticker=coin_ticker, shard=shard, amount=amount)
+        except IntegrityError:
+            #Created by another worker in the meantime
+            rows.update(amount=models.F('amount') + amount)
+
 #INNER ACCOUNT BALANCES MODEL: https://github.com/limpbrains/django-cc/blob/master/cc/models.py
 class Profile_User(Account_balances):
+    BALANCE_OWNER_TYPE = Coin_Balance.OWNER_PROFILE
     
     user = models.OneToOneField(User, on_delete=models.CASCADE)
 
-    @transaction.atomic()
-    def reduce_funds_bet(self, amount ,coin_ticker , casino_ref):
+    def apply_delta(self, delta, coin_ticker, reason, reference='', casino_ref=None):
+        """Change the balance of one coin by `delta` and record it in the BalanceLedger.
+
+        Single guarded statement on the Coin_Balance row of this coin:
+        UPDATE ... SET amount = amount + delta WHERE amount + delta >= 0 (no read-modify-write).
+        The opposite amount goes to the casino bankroll: casino_ref is required for the bet reasons.
+        """
+        if casino_ref is None and reason in BalanceLedger.BET_REASONS:
+            raise Casino_Bankroll.DoesNotExist('No casino bankroll for a bet settlement')
+        with transaction.atomic():
+            self.add_balance(coin_ticker, delta)
+            BalanceLedger.objects.create(user_id=self.user_id, coin_ticker=coin_ticker, delta=delta,
+                                         reason=reason, reference=str(reference))
+            if casino_ref is not None:
+                casino_ref.add_funds(-delta, coin_ticker)
+
+    def reduce_funds_bet(self, amount ,coin_ticker , casino_ref, reference=''):
         """ Check for sufficient funds for the user and reduce the amount of funds available based on the bet size for the specific coin"""
-        
-        
         if amount < 0:
             raise ValueError('Invalid Amount')
-        #Check for tickers (valid used coin):
-        if coin_ticker=="ETH":
-            if self.ETH_amount - amount < 0 :
-                raise ValueError('Not enough funds')
-            
-            else:
-                self.ETH_amount -= amount
-                self.save()
-                casino_ref.ETH_amount +=amount
-                casino_ref.save()
-        ######################
-        elif coin_ticker=="BTC":
-            if self.BTC_amount - amount < 0 :
-                raise ValueError('Not enough funds')
-            
-            else:
-                self.BTC_amount -= amount
-                self.save()
-                casino_ref.BTC_amount +=amount
-                casino_ref.save()
-        ######################
-        elif coin_ticker=="PLAY":
-            if self.PLAY_amount - amount < 0 :
-                raise ValueError('Not enough funds')
-            
-            else:
-                self.PLAY_amount -= amount
-                self.save()
-                casino_ref.PLAY_amount +=amount
-                casino_ref.save()
-        ######################
-        else:
-            raise ValueError('Bad ticker for bet')
-    
-    
-    @transaction.atomic()
-    def gain_funds(self, amount,coin_ticker , casino_ref): 
+        self.apply_delta(-amount, coin_ticker, BalanceLedger.REASON_BET, reference, casino_ref)
+
+    def gain_funds(self, amount,coin_ticker , casino_ref, reference=''): 
         """ USER WON BET; INCREASE COIN AMOUNT (ticker) AND REDUCE THE CASINO ACCOUNT VALUES"""
-        if coin_ticker=="ETH":
-                self.ETH_amount += amount
-                self.save()
-                casino_ref.ETH_amount -=amount
-                casino_ref.save()
-        ######################
-        elif coin_ticker=="BTC":
-                self.BTC_amount += amount
-                self.save()
-                casino_ref.BTC_amount -=amount
-                casino_ref.save()
-        ######################
-        elif coin_ticker=="PLAY":
-                self.PLAY_amount += amount
-                self.save()       
-                casino_ref.PLAY_amount -=amount
-                casino_ref.save()
-        else:
-            raise ValueError('Bad ticker for bet')
-    
-    @transaction.atomic()
-    def deposit_funds_wallet (self, amount,coin_ticker):
-        if coin_ticker=="ETH":
-                self.ETH_amount += amount
-                self.save()
-        ######################
-        elif coin_ticker=="BTC":
-                self.BTC_amount += amount
-                self.save()
-        ######################
-        elif coin_ticker=="PLAY":
-                self.PLAY_amount += amount
-                self.save()       
-        else:
-            raise ValueError('Bad ticker for bet')
+        self.apply_delta(amount, coin_ticker, BalanceLedger.REASON_WIN, reference, casino_ref)
+
+    def deposit_funds_wallet (self, amount,coin_ticker, reference=''):
+        self.apply_delta(amount, coin_ticker, BalanceLedger.REASON_DEPOSIT, reference)
             
     def __str__(self):
         return f'{self.user.name} Profile and balances'
 
 
+class BalanceLedger(models.Model):
+    """Append-only log of every change of the users balances.
+
+    Balance of a coin = sum of its deltas (the OPENING entry holds the default funds of a new profile).
+    """
+    REASON_OPENING = 'OPENING'
+    REASON_BET = 'BET'
+    REASON_WIN = 'WIN'
+    REASON_FLASH_BET = 'FLASH_BET'
+    REASON_DEPOSIT = 'DEPOSIT'
+    REASON_WITHDRAW = 'WITHDRAW'
+    REASON_CHOICES = [
+        (REASON_OPENING, 'Opening balance'),
+        (REASON_BET, 'Bet'),
+        (REASON_WIN, 'Win'),
+        (REASON_FLASH_BET, 'Flash bet settlement'),
+        (REASON_DEPOSIT, 'Deposit'),
+        (REASON_WITHDRAW, 'Withdrawal'), #negative, positive for a refund
+    ]
+    BET_REASONS = (REASON_BET, REASON_WIN, REASON_FLASH_BET) #the casino bankroll takes the opposite side
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+    )
+    coin_ticker = models.CharField('Coin_Ticker', max_length=20)
+    delta = models.DecimalField('Delta', max_digits=18, decimal_places=8)
+    reason = models.CharField('Reason', max_length=20, choices=REASON_CHOICES)
+    reference = models.CharField('Reference', max_length=100, blank=True) #id of the bet/deposit...
+    created_at = models.DateTimeField('Date_Created', default=now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'coin_ticker', 'id']),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError('Ledger entries are append-only')
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError('Ledger entries are append-only')
+
+    @classmethod
+    def balance(cls, user, coin_ticker):
+        """Rebuild the balance of a coin for a user from the ledger."""
+        return cls.objects.filter(user=user, coin_ticker=coin_ticker).aggregate(total=models.Sum('delta'))['total'] or 0
+
+    def __str__(self):
+        return f'{self.reason} {self.delta} {self.coin_ticker}'
+
+
 #Create a matching entry in PROFILE_USER Table everytime a user is created
 @receiver(post_save, sender=User)
 def update_profile_signal(sender, instance, created, **kwargs):
     if created:
-        Profile_User.objects.create(user=instance)
+        profile = Profile_User.objects.create(user=instance)
+        #Default funds of the coins (PLAY) + opening entries so the ledger sums to the balances
+        defaults = {ticker: amount for ticker, amount in Coin.registry().items() if amount}
+        Coin_Balance.objects.bulk_create([
+            Coin_Balance(owner_type=Coin_Balance.OWNER_PROFILE, owner_id=profile.pk, coin_id=ticker, amount=amount)
+            for ticker, amount in defaults.items()
+        ])
+        BalanceLedger.objects.bulk_create([
+            BalanceLedger(user=instance, coin_ticker=ticker, delta=amount, reason=BalanceLedger.REASON_OPENING)
+            for ticker, amount in defaults.items()
+        ])
     #instance.profile.save()
 
 
@@ -364,6 +855,36 @@ class Wallet(models.Model):
     assigned_to_user_date = models.DateTimeField('Date_Assigned',auto_now=True)
     value_amount = models.DecimalField('Amount', max_digits=18, decimal_places=8, default=0) #models.DecimalField(max_digits=6, decimal_places=5) 
     counter_deposits = models.PositiveIntegerField(default=0) #Number of deposits (unique) made to this wallet;
+
+    class Meta:
+        indexes = [
+            #Free addresses of each chain (pre-generated pool, utils/wallet_pool.py): only the unassigned rows are indexed
+            models.Index(fields=['blockchain', 'id'], condition=models.Q(user__isnull=True), name='wallet_unassigned_idx'),
+        ]
+
+    @classmethod
+    def assign(cls, user, blockchain):
+        """Deposit address of the user for a chain: his wallet, or one taken from the free pool.
+
+        SELECT ... FOR UPDATE SKIP LOCKED LIMIT 1 on the free rows + one UPDATE, so concurrent signups
+        never wait on the same candidate row. ValueError if the pool of the chain is empty.
+        """
+        wallet = cls.objects.filter(user=user, blockchain=blockchain).order_by('id').first()
+        if wallet is not None:
+            return wallet
+        for _ in range(3):
+            with transaction.atomic():
+                wallet = (cls.objects.select_for_update(skip_locked=True)
+                          .filter(blockchain=blockchain, user__isnull=True).order_by('id').first())
+                if wallet is None:
+                    break
+                #Only the worker that updates the free row gets it (no lock on some backends)
+                assigned_at = now()
+                if cls.objects.filter(pk=wallet.pk, user__isnull=True).update(user=user, assigned_to_user_date=assigned_at):
+                    wallet.user, wallet.assigned_to_user_date = user, assigned_at
+                    return wallet
+        raise ValueError('No free deposit address for ' + blockchain)
+
     def __str__(self):
         return str(self.public_key)#"User " + str(self.user.name) + " is assigned the adress: " + str(self.public_key) +" for blockchain" + str(self.blockchain)
     
@@ -399,6 +920,13 @@ class User_Deposit(models.Model):
         on_delete=models.CASCADE,
     )
     """
+
+    class Meta:
+        constraints = [
+            #A chain transaction is credited once (also the index of the dedup lookups of utils/deposit_ingestion.py)
+            models.UniqueConstraint(fields=['blockchain', 'unique_trx_hash'], name='unique_deposit_trx'),
+        ]
+
     def __str__(self):
         """Simply present name of user connected with deposit and amount."""
         return self.user_id.name + " made " + str(self.amount) + " deposit of "+ self.coin_ticker
@@ -407,15 +935,50 @@ class User_Deposit(models.Model):
 
 
 
+class Withdraw_Batch(models.Model):
+    """One multi-output payout transaction grouping the withdrawals of a chain & coin (utils/withdrawals.py)."""
+    STATUS_SIGNING = 'SIGNING'
+    STATUS_SENT = 'SENT'
+    STATUS_FAILED = 'FAILED'
+    STATUS_CHOICES = [
+        (STATUS_SIGNING, 'Signing'), #debited, handed to the signer
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    blockchain = models.CharField('Blockchain', max_length=20)
+    coin_ticker = models.CharField('Coin_Ticker', max_length=20)
+    status = models.CharField('Status', max_length=10, choices=STATUS_CHOICES, default=STATUS_SIGNING)
+    total_amount = models.DecimalField('Total_Amount', max_digits=18, decimal_places=8, default=0)
+    trx_hash = models.CharField('Transaction_Hash', max_length=125, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField('Date_Created', default=now)
+    sent_at = models.DateTimeField('Date_Sent', null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.blockchain} {self.coin_ticker} batch {self.pk}: {self.status}'
+
+
 class User_Withdraw(models.Model):
     """Represent user's willingness to withdraw money.
 
     Define fields to store amount of money, using Decimal field with
-    two places precision and maximal six digits, time when withdraw will
+    eight places precision (same as the deposits and balances), time when withdraw will
     was signaled and connect every withdraw with user and used currency.
+    Pending withdrawals are debited and paid by batches (utils/withdrawals.py).
     """
+    STATUS_PENDING = 'PENDING'
+    STATUS_PROCESSING = 'PROCESSING'
+    STATUS_SENT = 'SENT'
+    STATUS_FAILED = 'FAILED'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'), #debited, in a batch being signed
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'), #not debited or refunded
+    ]
 
-    amount = models.DecimalField(max_digits=6, decimal_places=2)
+    amount = models.DecimalField(max_digits=18, decimal_places=8)
     address = models.CharField(max_length=100)
     withdraw_time = models.DateTimeField()
     user_id = models.ForeignKey(
@@ -428,6 +991,17 @@ class User_Withdraw(models.Model):
         on_delete=models.CASCADE,
     )
     """
+    blockchain = models.CharField('Blockchain', max_length=20, default='ETH')
+    coin_ticker = models.CharField('Coin_Ticker', max_length=20, default='ETH')
+    status = models.CharField('Status', max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    batch = models.ForeignKey(Withdraw_Batch, on_delete=models.SET_NULL, null=True, blank=True, related_name='withdrawals')
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'blockchain', 'coin_ticker', 'id']), #pending withdrawals of a chain & coin, oldest first
+        ]
+
     def __str__(self):
         """Simply present name of user connected with withdraw and amount."""
         return self.user_id.name + " wants to withdraw " + str(self.amount)
@@ -453,20 +1027,19 @@ def save_model_instance(instance , updatefields=None):
                 
     except ValidationError as ve:
         # Handle validation errors
-        print("Validation error occurred:", ve)
+        logger.warning("Validation error occurred: %s", ve)
         # You can return the error or raise a custom exception here
     except IntegrityError as ie:
         # Handle integrity errors, like unique constraints violations
-        print("Integrity error occurred:", ie)
+        logger.warning("Integrity error occurred: %s", ie)
         # You can return the error or raise a custom exception here
     except DatabaseError as de:
         # Handle general database errors
-        print("Database error occurred:", de)
+        logger.error("Database error occurred: %s", de)
         # You can return the error or raise a custom exception here
     except Exception as e:
         # Handle any other unexpected exceptions
-        print("Unexpected error occurred:", e)
+        logger.exception("Unexpected error occurred: %s", e)
         # You can return the error or raise a custom exception here
     else:
-        print("Model saved successfully.")
         return instance
@@ -0,0 +1,217 @@
+"""
+Django command benchmarking the betting & seed hot paths (core/management/commands/bench_hot_paths.py).
+
+Runs on a throw-away test database created from the configured one, so run it once per
+database settings (SQLite and the local Postgres) to get both numbers; the vendor is in the results.
+
+    python manage.py bench_hot_paths --output bench_sqlite.json
+    python manage.py bench_hot_paths --compare bench_sqlite.json --threshold 0.10   #fails on regressions
+
+Cases:
+- rolls: raw provably fair roll throughput (single roll & batch)
+- flash_bet_<n>: process_flash_bet end to end (API view) with 1, 100, 10k and 100k bets
+- reveal_server_seed / change_server_seed: seed API views
+- settlement_concurrent: Profile_User.apply_delta from concurrent writers (+ final balance check)
+"""
+import json
+import platform
+import statistics
+import threading
+import time
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, close_old_connections, DatabaseError
+from django.test.utils import setup_databases, teardown_databases
+from django.utils.timezone import now
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from core.models import Profile_User, Casino_Bankroll, BalanceLedger
+from flash_bets.views import FlashBetViewSet
+from seeds.views import Seed_ViewSet
+from utils import dice_rolls
+from utils.history_writer import history_writer
+
+FLASH_BET_SIZES = (1, 100, 10000, 100000)
+
+
+def _timings(func, repeat):
+    """Run func `repeat` times, return the list of durations (seconds)."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _stats(durations, operations=1, **extra):
+    median = statistics.median(durations)
+    ordered = sorted(durations)
+    return {
+        'runs': len(durations),
+        'min': ordered[0],
+        'median': median,
+        'mean': statistics.fmean(durations),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'ops_per_sec': operations / median if median else None,
+        **extra,
+    }
+
+
+class Command(BaseCommand):
+    """Django command to benchmark the hot paths and compare with a previous run."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None, help='Write the JSON results to this file (stdout otherwise).')
+        parser.add_argument('--compare', default=None, help='Previous JSON results to compare with.')
+        parser.add_argument('--threshold', type=float, default=0.10, help='Allowed slowdown of the median (0.10 = 10%%).')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per case.')
+        parser.add_argument('--writers', type=int, default=8, help='Concurrent writers for the settlement case.')
+        parser.add_argument('--only', default=None, help='Only run the cases starting with this name.')
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            results = self.run_cases(options)
+        finally:
+            history_writer.stop()
+            teardown_databases(old_config, verbosity=0)
+
+        report = {
+            'meta': {
+                'date': now().isoformat(),
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+            },
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            self.compare(results, options['compare'], options['threshold'])
+
+    def run_cases(self, options):
+        cases = [
+            ('rolls', self.bench_rolls),
+            ('flash_bet', self.bench_flash_bets),
+            ('seeds', self.bench_seeds),
+            ('settlement_concurrent', self.bench_settlement),
+        ]
+        results = {}
+        for name, bench in cases:
+            if options['only'] and not name.startswith(options['only']):
+                continue
+            results.update(bench(options))
+        return results
+
+    def _user(self, email, funds=Decimal('1000000000')):
+        user = get_user_model().objects.create_user(email=email, password='bench-pass')
+        Profile_User.objects.get(user=user).deposit_funds_wallet(funds, 'PLAY')
+        return user
+
+    def bench_rolls(self, options):
+        count = 100000
+        single = _timings(lambda: [dice_rolls.roll('bench-seed', 'client', nonce) for nonce in range(1000)], options['repeat'])
+        batch = _timings(lambda: dice_rolls.roll_range('bench-seed', 'client', 0, count), options['repeat'])
+        return {
+            'rolls_single': _stats(single, 1000),
+            'rolls_batch': _stats(batch, count),
+        }
+
+    def bench_flash_bets(self, options):
+        if Casino_Bankroll.objects.first() is None:
+            Casino_Bankroll.objects.create()
+        user = self._user('bench-flash@example.com')
+        view = FlashBetViewSet.as_view({'post': 'process_flash_bet'})
+        factory = APIRequestFactory()
+        results = {}
+        for size in FLASH_BET_SIZES:
+            statuses = []
+
+            def run():
+                request = factory.post('/flash_bets/process/', {
+                    'number_of_bets': size,
+                    'bet_amount': '0.01',
+                    'coin_ticker': 'PLAY',
+                    'user_winrate_choice': '49.50',
+                    'is_roll_under': True,
+                }, format='json')
+                force_authenticate(request, user=user)
+                statuses.append(view(request).status_code)
+
+            repeat = options['repeat'] if size < 100000 else max(1, options['repeat'] // 2)
+            results['flash_bet_' + str(size)] = _stats(_timings(run, repeat), size, statuses=sorted(set(statuses)))
+        return results
+
+    def bench_seeds(self, options):
+        user = self._user('bench-seeds@example.com')
+        factory = APIRequestFactory()
+        results = {}
+        for name, method, view in (
+            ('reveal_server_seed', 'get', Seed_ViewSet.as_view({'get': 'reveal_server_seed'})),
+            ('change_server_seed', 'put', Seed_ViewSet.as_view({'put': 'change_server_seed'})),
+        ):
+            statuses = []
+
+            def run():
+                request = getattr(factory, method)('/seeds/' + name + '/', {}, format='json')
+                force_authenticate(request, user=user)
+                statuses.append(view(request).status_code)
+
+            results[name] = _stats(_timings(run, options['repeat'] * 20), statuses=sorted(set(statuses)))
+        return results
+
+    def bench_settlement(self, options):
+        """Concurrent apply_delta on one profile; the final balance must match the ledger."""
+        user = self._user('bench-settle@example.com')
+        casino = Casino_Bankroll.objects.first() or Casino_Bankroll.objects.create()
+        writers, per_writer = options['writers'], 200
+        errors = []
+
+        def writer():
+            try:
+                profile = Profile_User.objects.get(user=user)
+                for index in range(per_writer):
+                    profile.apply_delta(Decimal('1') if index % 2 else Decimal('-1'), 'PLAY',
+                                        BalanceLedger.REASON_BET, 'bench', casino)
+            except (DatabaseError, ValueError) as e:
+                errors.append(str(e))
+            finally:
+                close_old_connections()
+
+        def run():
+            threads = [threading.Thread(target=writer) for _ in range(writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        durations = _timings(run, options['repeat'])
+        profile = Profile_User.objects.get(user=user)
+        consistent = profile.get_balance('PLAY') == BalanceLedger.balance(user, 'PLAY')
+        return {'settlement_concurrent': _stats(durations, writers * per_writer, writers=writers,
+                                                errors=len(errors), balance_consistent=consistent)}
+
+    def compare(self, results, path, threshold):
+        with open(path) as f:
+            baseline = json.load(f)['results']
+        regressions = []
+        for name, current in sorted(results.items()):
+            previous = baseline.get(name)
+            if previous is None:
+                continue
+            change = current['median'] / previous['median'] - 1 if previous['median'] else 0
+            flag = 'REGRESSION' if change > threshold else 'ok'
+            self.stdout.write(f'{name:28} {previous["median"]:.6f}s -> {current["median"]:.6f}s ({change:+.1%}) {flag}')
+            if change > threshold:
+                regressions.append(name)
+        if regressions:
+            raise CommandError('Regressions: ' + ', '.join(regressions))
@@ -0,0 +1,48 @@
+"""
+Django command to check the batched rolls against the single provably fair roll (core/management/commands/check_roll_parity.py).
+
+utils/dice_rolls.py re-implements the roll of provably_fair_dice.ProvablyFair for whole nonce ranges:
+this replays random seeds (or the given ones) with both and fails on the first difference.
+    python manage.py check_roll_parity --seeds 20 --count 10000
+    python manage.py check_roll_parity --server-seed S --client-seed C --nonce-start 0 --count 100000
+"""
+from secrets import token_hex
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils import dice_rolls
+
+
+class Command(BaseCommand):
+    """Django command to check the parity of the batched rolls with ProvablyFair.roll."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server-seed', default=None, help='Server seed (random seeds otherwise).')
+        parser.add_argument('--client-seed', default=None, help='Client seed (random seeds otherwise).')
+        parser.add_argument('--nonce-start', type=int, default=0)
+        parser.add_argument('--count', type=int, default=10000, help='Nonces per seed.')
+        parser.add_argument('--seeds', type=int, default=10, help='Random seed pairs to check.')
+        parser.add_argument('--min-fallbacks', type=int, default=100,
+                            help='Fallback digests (first chunk >= 10**6) to compare per seed.')
+
+    def handle(self, *args, **options):
+        if options['server_seed'] and options['client_seed']:
+            pairs = [(options['server_seed'], options['client_seed'])]
+        elif options['server_seed'] or options['client_seed']:
+            raise CommandError('Give both --server-seed and --client-seed, or none.')
+        else:
+            pairs = [(token_hex(32), token_hex(8)) for _ in range(options['seeds'])]
+
+        total = total_fallbacks = 0
+        for server_seed, client_seed in pairs:
+            compared, fallbacks, mismatches = dice_rolls.check_parity(
+                server_seed, client_seed, options['nonce_start'], options['count'], options['min_fallbacks'])
+            total += compared
+            total_fallbacks += fallbacks
+            if mismatches:
+                nonce, batch_roll, reference_roll = mismatches[0]
+                raise CommandError(str(len(mismatches)) + ' mismatches for server seed ' + server_seed + ' / client seed '
+                                   + client_seed + ', first at nonce ' + str(nonce) + ': ' + batch_roll + ' != ' + reference_roll)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Rolls identical to ProvablyFair.roll: ' + str(total) + ' nonces, ' + str(total_fallbacks) + ' fallback digests.'))
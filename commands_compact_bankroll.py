@@ -0,0 +1,21 @@
+"""
+Django command to fold the Casino_Bankroll shards back into the bankroll (core/management/commands/compact_bankroll.py).
+
+Meant to be run periodically (cron), for example every minute:
+    python manage.py compact_bankroll
+"""
+from django.core.management.base import BaseCommand
+
+from core.models import Casino_Bankroll
+
+
+class Command(BaseCommand):
+    """Django command to compact the bankroll shards."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--coin', default=None, help='Only compact this coin ticker (default: all).')
+
+    def handle(self, *args, **options):
+        for bankroll in Casino_Bankroll.objects.all():
+            bankroll.compact_shards(options['coin'])
+            self.stdout.write(self.style.SUCCESS(f'Bankroll {bankroll.label} compacted.'))
@@ -0,0 +1,35 @@
+"""
+Django command ingesting the blockchain deposits by batches (core/management/commands/ingest_deposits.py).
+
+From a JSON lines file (fixtures, replays):  python manage.py ingest_deposits --file deposits.jsonl
+From the configured source (DEPOSIT_SOURCE): python manage.py ingest_deposits --batch-size 5000
+"""
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils import deposit_ingestion
+
+
+class Command(BaseCommand):
+    """Django command to ingest chain transactions into User_Deposit and credit the users."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=None, help='JSON lines file of chain transactions.')
+        parser.add_argument('--batch-size', type=int, default=deposit_ingestion.DEPOSIT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['file']:
+            source = deposit_ingestion.FileDepositSource(options['file'])
+        elif deposit_ingestion.DEPOSIT_SOURCE:
+            source = deposit_ingestion.get_deposit_source()
+        else:
+            raise CommandError('Give --file or set DEPOSIT_SOURCE in the settings.')
+
+        totals = Counter()
+        for stats in deposit_ingestion.ingest(source, options['batch_size']):
+            totals.update(stats)
+            self.stdout.write(f"batch: {stats['received']} received, {stats['inserted']} new")
+        self.stdout.write(self.style.SUCCESS(
+            f"{totals['inserted']} deposits ingested ({totals['duplicate']} duplicates, "
+            f"{totals['unknown_address']} unknown addresses, {totals['invalid']} invalid)."))
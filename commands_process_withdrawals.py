@@ -0,0 +1,33 @@
+"""
+Django command paying the pending withdrawals by batches (core/management/commands/process_withdrawals.py).
+
+Once (cron):            python manage.py process_withdrawals
+As a background worker: python manage.py process_withdrawals --loop --interval 30
+The signer is settings.WITHDRAW_SIGNER (utils.withdrawals.FakeSigner for tests & dev).
+"""
+from django.core.management.base import CommandError
+
+from utils import withdrawals
+from utils.periodic_command import PeriodicCommand
+
+
+class Command(PeriodicCommand):
+    """Django command to debit, sign and send the withdrawals grouped by chain & coin."""
+    default_interval = 30
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--batch-size', type=int, default=withdrawals.WITHDRAW_BATCH_SIZE, help='Outputs per payout.')
+        parser.add_argument('--window', type=float, default=withdrawals.WITHDRAW_BATCH_WINDOW,
+                            help='Seconds a withdrawal can wait for a full batch.')
+
+    def setup(self, **options):
+        try:
+            self.signer = withdrawals.get_signer()
+        except (ImportError, ValueError) as e:
+            raise CommandError(str(e))
+
+    def run_once(self, **options):
+        sent = withdrawals.process_pending(self.signer, options['batch_size'], options['window'])
+        if sent:
+            self.stdout.write(self.style.SUCCESS(f'{sent} withdrawal batches sent.'))
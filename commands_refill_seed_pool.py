@@ -0,0 +1,23 @@
+"""
+Django command to keep the pre-generated server seeds pool filled (core/management/commands/refill_seed_pool.py).
+
+Once (cron):            python manage.py refill_seed_pool
+As a background worker: python manage.py refill_seed_pool --loop --interval 5
+"""
+from core.models import ServerSeedPool
+from utils.periodic_command import PeriodicCommand
+
+
+class Command(PeriodicCommand):
+    """Django command to refill the ServerSeedPool above its low-water mark."""
+    default_interval = 5
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--low-water', type=int, default=None, help='Refill when the pool is below this.')
+        parser.add_argument('--target', type=int, default=None, help='Number of seeds after a refill.')
+
+    def run_once(self, **options):
+        added = ServerSeedPool.refill(options['low_water'], options['target'])
+        if added:
+            self.stdout.write(self.style.SUCCESS(f'{added} server seeds added to the pool.'))
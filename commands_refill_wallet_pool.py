@@ -0,0 +1,34 @@
+"""
+Django command to keep the pre-generated deposit addresses pool filled (core/management/commands/refill_wallet_pool.py).
+
+Once (cron):            python manage.py refill_wallet_pool
+As a background worker: python manage.py refill_wallet_pool --loop --interval 30
+One chain only:         python manage.py refill_wallet_pool --blockchain ETH
+"""
+from django.core.management.base import CommandError
+
+from utils import wallet_pool
+from utils.periodic_command import PeriodicCommand
+
+
+class Command(PeriodicCommand):
+    """Django command to refill the free Wallet rows of each chain above their low-water mark."""
+    default_interval = 30
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--blockchain', action='append', default=None, help='Chain to refill (default: WALLET_POOL_CHAINS).')
+        parser.add_argument('--low-water', type=int, default=None, help='Refill when the pool is below this.')
+        parser.add_argument('--target', type=int, default=None, help='Number of free addresses after a refill.')
+
+    def setup(self, **options):
+        try:
+            self.generator = wallet_pool.get_address_generator()
+        except (ImportError, ValueError) as e:
+            raise CommandError(str(e))
+
+    def run_once(self, **options):
+        for blockchain in options['blockchain'] or wallet_pool.WALLET_POOL_CHAINS:
+            added = wallet_pool.refill(blockchain, options['low_water'], options['target'], generator=self.generator)
+            if added:
+                self.stdout.write(self.style.SUCCESS(f'{added} {blockchain} addresses added to the pool.'))
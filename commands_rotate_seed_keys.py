@@ -0,0 +1,74 @@
+"""
+Django command re-encrypting the stored server seeds with the current key (core/management/commands/rotate_seed_keys.py).
+
+    python manage.py rotate_seed_keys                          #Seed, ServerSeedPool & FlashBet rows, current key
+    python manage.py rotate_seed_keys --checkpoint rotation.json --workers 8
+    python manage.py rotate_seed_keys --check                  #rows per key version (is the old key still used?)
+
+Runs live (chunks are locked one at a time) and resumes from the checkpoint file after an interruption.
+"""
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Seed, ServerSeedPool, FlashBet
+from utils import seed_keys
+
+TARGETS = {
+    'seed': (Seed, 'server_seed'),
+    'pool': (ServerSeedPool, 'server_seed'),
+    'flash_bet': (FlashBet, 'server_seed'),
+}
+
+
+class Command(BaseCommand):
+    """Django command to rotate the encryption key of the server seeds."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--key-version', type=int, default=None, help='Key version to encrypt with (default: current).')
+        parser.add_argument('--only', choices=sorted(TARGETS), action='append', default=None, help='Tables to rotate (default: all).')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Rows per chunk (one transaction).')
+        parser.add_argument('--workers', type=int, default=None, help='Size of the process pool.')
+        parser.add_argument('--checkpoint', default='seed_key_rotation.json', help='Progress file (resume).')
+        parser.add_argument('--check', action='store_true', help='Only count the rows by key version.')
+
+    def handle(self, *args, **options):
+        names = options['only'] or list(TARGETS)
+        if options['check']:
+            for name in names:
+                model, field = TARGETS[name]
+                self.stdout.write(f'{name}: {seed_keys.count_by_version(model, field)}')
+            return
+
+        version = options['key_version'] or seed_keys.current_version()
+        checkpoint = self.load_checkpoint(options['checkpoint'], version)
+        for name in names:
+            model, field = TARGETS[name]
+            total = 0
+            try:
+                for last_pk, updated in seed_keys.rotate(model, field, checkpoint['after'].get(name, 0), version,
+                                                         options['chunk_size'], options['workers']):
+                    total += updated
+                    checkpoint['after'][name] = last_pk
+                    self.save_checkpoint(options['checkpoint'], checkpoint)
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(self.style.SUCCESS(f'{name}: {total} rows re-encrypted with key version {version}.'))
+        if os.path.exists(options['checkpoint']):
+            os.remove(options['checkpoint'])
+
+    def load_checkpoint(self, path, version):
+        if not os.path.exists(path):
+            return {'version': version, 'after': {}}
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint['version'] != version:
+            raise CommandError(f'{path} is a rotation to version {checkpoint["version"]}, remove it to start over.')
+        return checkpoint
+
+    def save_checkpoint(self, path, checkpoint):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp, path) #atomic: never a half written checkpoint
@@ -0,0 +1,27 @@
+"""
+Django command running the workers of the big flash bets (core/management/commands/run_flash_bet_workers.py).
+
+    python manage.py run_flash_bet_workers --workers 4
+Run one command per core (the rolls are CPU bound) for more throughput.
+"""
+from django.core.management.base import BaseCommand
+
+from utils.flash_bet_jobs import FlashBetWorkerPool
+
+
+class Command(BaseCommand):
+    """Django command to execute the queued flash bet jobs."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help='Number of worker threads.')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between two polls when idle.')
+
+    def handle(self, *args, **options):
+        pool = FlashBetWorkerPool(options['workers'], options['poll_interval'])
+        pool.start()
+        self.stdout.write(self.style.SUCCESS(f"{options['workers']} flash bet workers started."))
+        try:
+            pool.requeue_stale_forever()
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping, waiting for the running jobs...')
+            pool.stop()
@@ -0,0 +1,85 @@
+"""
+Django command simulating the house edge & bankroll risk (core/management/commands/simulate_bankroll.py).
+
+    python manage.py simulate_bankroll --trials 20000 --sessions 1000            #bet mix of the real flash bets
+    python manage.py simulate_bankroll --profiles mix.json --payout-factor 1.01  #payouts 1% higher
+    python manage.py simulate_bankroll --bankroll ETH=150 --output risk.json
+
+mix.json: list of {coin_ticker, user_winrate_choice, is_roll_under, bet_amount, number_of_bets, weight}.
+Run it before every payout change (compute_dice_setup) or max bet change; needs NumPy.
+"""
+import json
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Casino_Bankroll
+
+
+class Command(BaseCommand):
+    """Django command to run the Monte Carlo bankroll simulation."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trials', type=int, default=10000, help='Simulated periods.')
+        parser.add_argument('--sessions', type=int, default=1000, help='Flash bets per period.')
+        parser.add_argument('--profiles', default=None, help='JSON bet mix (default: the real flash bets).')
+        parser.add_argument('--history-limit', type=int, default=1000, help='Bet profiles taken from the history.')
+        parser.add_argument('--bankroll', action='append', default=[], help='COIN=amount (default: current bankroll).')
+        parser.add_argument('--payout-factor', type=float, default=1.0, help='Scale of the payouts to test.')
+        parser.add_argument('--workers', type=int, default=None, help='Size of the process pool.')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed (reproducible runs).')
+        parser.add_argument('--output', default=None, help='Write the JSON report to this file (stdout otherwise).')
+
+    def handle(self, *args, **options):
+        try:
+            from utils import bankroll_simulation
+        except ImportError as e:
+            raise CommandError('The simulation needs NumPy: ' + str(e))
+
+        if options['profiles']:
+            with open(options['profiles']) as f:
+                items = json.load(f)
+            try:
+                profiles = bankroll_simulation.profiles_from_dicts(items)
+            except (KeyError, TypeError, ValueError, InvalidOperation) as e:
+                raise CommandError('Invalid bet profiles: ' + repr(e))
+        else:
+            profiles = bankroll_simulation.profiles_from_history(options['history_limit'])
+        if not profiles:
+            raise CommandError('No bet profiles (no flash bets yet?), give --profiles.')
+
+        bankrolls = self.bankrolls(profiles, options['bankroll'])
+        try:
+            report = bankroll_simulation.simulate(
+                profiles, trials=options['trials'], sessions=options['sessions'], bankrolls=bankrolls,
+                workers=options['workers'], seed=options['seed'], payout_factor=options['payout_factor'])
+        except ValueError as e:
+            raise CommandError('Invalid bet profiles: ' + str(e))
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def bankrolls(self, profiles, overrides):
+        """{coin: bankroll}: --bankroll values, else the current casino bankroll of the coins simulated."""
+        bankrolls = {}
+        try:
+            casino = Casino_Bankroll.get_cached()
+        except Casino_Bankroll.DoesNotExist:
+            casino = None
+        if casino is not None:
+            for coin in {profile.coin_ticker for profile in profiles}:
+                try:
+                    bankrolls[coin] = casino.get_total(coin)
+                except ValueError:
+                    pass #coin not in the registry anymore
+        for value in overrides:
+            coin, _, amount = value.partition('=')
+            try:
+                bankrolls[coin] = Decimal(amount)
+            except InvalidOperation:
+                raise CommandError('Invalid --bankroll ' + value + ' (COIN=amount)')
+        return bankrolls
@@ -0,0 +1,22 @@
+"""
+Django command deleting the expired idempotency keys (core/management/commands/sweep_idempotency_keys.py).
+
+Once (cron):            python manage.py sweep_idempotency_keys
+As a background worker: python manage.py sweep_idempotency_keys --loop --interval 600
+"""
+from utils import idempotency
+from utils.periodic_command import PeriodicCommand
+
+
+class Command(PeriodicCommand):
+    """Django command to delete the idempotency keys older than their TTL."""
+    default_interval = 600
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--ttl', type=int, default=idempotency.IDEMPOTENCY_TTL, help='Age (seconds) of the keys to delete.')
+
+    def run_once(self, **options):
+        deleted = idempotency.sweep(options['ttl'])
+        if deleted:
+            self.stdout.write(self.style.SUCCESS(f'{deleted} idempotency keys deleted.'))
@@ -0,0 +1,61 @@
+"""
+Django command to verify revealed seeds in bulk (core/management/commands/verify_seeds.py).
+
+One seed:
+    python manage.py verify_seeds --server-seed S --client-seed C --nonce-start 0 --count 1000000 --user-email a@b.c
+Many seeds (one JSON object per line with server_seed, client_seed, nonce_start, count, hashed_server_seed):
+    python manage.py verify_seeds --file seeds.jsonl --no-rolls
+Results are written to stdout as NDJSON (seed / chunk / mismatch / summary lines).
+"""
+import json
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from utils import seed_verification
+
+
+class Command(BaseCommand):
+    """Django command to replay and check the rolls of revealed seeds."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server-seed', help='Revealed server seed.')
+        parser.add_argument('--client-seed', help='Client seed.')
+        parser.add_argument('--nonce-start', type=int, default=0)
+        parser.add_argument('--count', type=int, help='Number of nonces to replay.')
+        parser.add_argument('--hashed-server-seed', default=None, help='Hash shown before the reveal.')
+        parser.add_argument('--file', help='JSON lines file with many seeds.')
+        parser.add_argument('--user-email', default=None, help='Compare with the stored history of this user.')
+        parser.add_argument('--workers', type=int, default=None, help='Size of the process pool.')
+        parser.add_argument('--no-rolls', action='store_true', help='Only output mismatches and summaries.')
+
+    def handle(self, *args, **options):
+        if options['file']:
+            with open(options['file']) as f:
+                specs = [json.loads(line) for line in f if line.strip()]
+        elif options['server_seed'] and options['client_seed'] and options['count'] is not None:
+            specs = [{
+                'server_seed': options['server_seed'],
+                'client_seed': options['client_seed'],
+                'nonce_start': options['nonce_start'],
+                'count': options['count'],
+                'hashed_server_seed': options['hashed_server_seed'],
+            }]
+        else:
+            raise CommandError('Give --file or --server-seed, --client-seed and --count.')
+
+        user = None
+        if options['user_email']:
+            user = get_user_model().objects.filter(email=options['user_email']).first()
+            if user is None:
+                raise CommandError('Unknown user ' + options['user_email'])
+
+        mismatches = 0
+        for record in seed_verification.verify_seeds(specs, user=user, include_rolls=not options['no_rolls'],
+                                                     workers=options['workers']):
+            if record['type'] == 'summary':
+                mismatches += record['mismatches']
+            self.stdout.write(json.dumps(record))
+
+        if mismatches:
+            raise CommandError(str(mismatches) + ' mismatches found.')
@@ -0,0 +1,164 @@
+"""
+Monte Carlo simulation of the house edge & bankroll risk (utils/bankroll_simulation.py).
+
+A trial plays `sessions` flash bets, each one drawn from a mix of bet profiles
+(coin, winrate choice, direction, bet size, number of bets) by weight. The wins of a session
+are drawn from a binomial with the exact win probability of its dice setup
+(share of the 10000 roll values in its range), so millions of rolls cost one vectorized NumPy draw.
+Trials are sharded across a process pool.
+
+For each coin the report gives the distribution of the casino profit, the maximum drawdown,
+the exposure (stakes & biggest possible payout) and the risk of ruin for the current bankroll.
+
+NumPy is only needed here (simulate_bankroll command), not by the casino itself.
+"""
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count
+
+from core.models import FlashBet
+from utils import dice_rolls, dice_table
+
+MAX_WORKERS = getattr(settings, 'SIMULATION_MAX_WORKERS', os.cpu_count() or 1)
+CHUNK_CELLS = 1000000 #trials x sessions simulated at once (memory bound of a worker)
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+BetProfile = namedtuple('BetProfile', ['coin_ticker', 'user_winrate_choice', 'is_roll_under', 'bet_amount', 'number_of_bets', 'weight'])
+
+
+def profiles_from_history(limit=1000):
+    """Bet mix of the real flash bets: the `limit` most frequent (coin, choice, direction, bet, size)."""
+    fields = ('coin_ticker', 'user_winrate_choice', 'is_roll_under', 'bet_amount', 'number_of_bets')
+    rows = (FlashBet.objects.filter(number_of_bets__gt=0).values(*fields)
+            .annotate(weight=Count('id')).order_by('-weight')[:limit])
+    return [BetProfile(**row) for row in rows]
+
+
+def profiles_from_dicts(items):
+    """Bet mix from a JSON list of objects (weight defaults to 1)."""
+    return [BetProfile(
+        coin_ticker=item['coin_ticker'],
+        user_winrate_choice=Decimal(str(item['user_winrate_choice'])),
+        is_roll_under=bool(item.get('is_roll_under', True)),
+        bet_amount=Decimal(str(item['bet_amount'])),
+        number_of_bets=int(item.get('number_of_bets', 1)),
+        weight=float(item.get('weight', 1)),
+    ) for item in items]
+
+
+def _profile_arrays(profiles, payout_factor=1.0):
+    """Profiles -> numpy columns (coins as indexes). Invalid dice choices raise ValueError."""
+    coins = sorted({profile.coin_ticker for profile in profiles})
+    coin_index, bets, win_prob, house_loss, house_gain, weights = [], [], [], [], [], []
+    for profile in profiles:
+        params = dice_table.get_dice_setup(profile.user_winrate_choice, profile.is_roll_under)
+        mask = dice_rolls.win_mask(params.min_range, params.max_range)
+        coin_index.append(coins.index(profile.coin_ticker))
+        bets.append(profile.number_of_bets)
+        win_prob.append(sum(mask) / dice_rolls.ROLL_VALUES)
+        house_loss.append(float(profile.bet_amount * params.payout_X) * payout_factor - float(profile.bet_amount)) #paid on a user win (payout scaled, not the net win)
+        house_gain.append(float(profile.bet_amount)) #kept on a user loss
+        weights.append(float(profile.weight))
+    weights = np.array(weights)
+    return coins, {
+        'coin': np.array(coin_index, dtype=np.int64),
+        'bets': np.array(bets, dtype=np.int64),
+        'win_prob': np.array(win_prob),
+        'house_loss': np.array(house_loss),
+        'house_gain': np.array(house_gain),
+        'weight': weights / weights.sum(),
+    }
+
+
+def _simulate_shard(task):
+    """Simulate `trials` trials; returns per trial & coin: final profit, max drawdown, lowest profit."""
+    arrays, n_coins, trials, sessions, seed = task
+    rng = np.random.default_rng(seed)
+    final = np.zeros((trials, n_coins))
+    drawdown = np.zeros((trials, n_coins))
+    lowest = np.zeros((trials, n_coins))
+    rolls = 0
+    step = max(1, CHUNK_CELLS // sessions)
+    for start in range(0, trials, step):
+        size = min(step, trials - start)
+        picks = rng.choice(len(arrays['weight']), size=(size, sessions), p=arrays['weight'])
+        bets = arrays['bets'][picks]
+        wins = rng.binomial(bets, arrays['win_prob'][picks])
+        profit = (bets - wins) * arrays['house_gain'][picks] - wins * arrays['house_loss'][picks]
+        rolls += int(bets.sum())
+        coin = arrays['coin'][picks]
+        for index in range(n_coins):
+            path = np.cumsum(np.where(coin == index, profit, 0), axis=1)
+            peak = np.maximum.accumulate(np.maximum(path, 0), axis=1) #the bankroll starts at profit 0
+            final[start:start + size, index] = path[:, -1]
+            drawdown[start:start + size, index] = (peak - path).max(axis=1)
+            lowest[start:start + size, index] = np.minimum(path.min(axis=1), 0)
+    return final, drawdown, lowest, rolls
+
+
+def _distribution(values):
+    return {
+        'mean': float(values.mean()),
+        'std': float(values.std()),
+        **{'p' + str(q): float(v) for q, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))},
+    }
+
+
+def simulate(profiles, trials=10000, sessions=1000, bankrolls=None, workers=None, seed=None, payout_factor=1.0):
+    """Run the simulation and return the report (dict, JSON ready).
+
+    bankrolls: {coin: current bankroll} for the risk of ruin (probability the profit goes below -bankroll).
+    payout_factor: scale the payouts (e.g. 1.01) to test a payout change before doing it in compute_dice_setup.
+    """
+    if not profiles:
+        raise ValueError('No bet profiles to simulate')
+    coins, arrays = _profile_arrays(profiles, payout_factor)
+    workers = max(1, min(workers or MAX_WORKERS, trials))
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    shares = [trials // workers + (1 if index < trials % workers else 0) for index in range(workers)]
+    tasks = [(arrays, len(coins), share, sessions, child) for share, child in zip(shares, seeds) if share]
+
+    if len(tasks) == 1:
+        results = [_simulate_shard(tasks[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=len(tasks)) as pool:
+            results = list(pool.map(_simulate_shard, tasks))
+    final = np.concatenate([result[0] for result in results])
+    drawdown = np.concatenate([result[1] for result in results])
+    lowest = np.concatenate([result[2] for result in results])
+
+    bankrolls = bankrolls or {}
+    report = {
+        'trials': trials,
+        'sessions_per_trial': sessions,
+        'rolls': sum(result[3] for result in results),
+        'payout_factor': payout_factor,
+        'coins': {},
+    }
+    mean_bets = arrays['bets'] * arrays['weight']
+    for index, coin in enumerate(coins):
+        in_coin = arrays['coin'] == index
+        stake_per_session = float((mean_bets * arrays['house_gain'])[in_coin].sum())
+        expected_per_session = float((mean_bets * (
+            (1 - arrays['win_prob']) * arrays['house_gain'] - arrays['win_prob'] * arrays['house_loss']))[in_coin].sum())
+        coin_report = {
+            'profit': _distribution(final[:, index]),
+            'max_drawdown': _distribution(drawdown[:, index]),
+            'exposure': {
+                'expected_stakes_per_trial': stake_per_session * sessions,
+                'max_session_payout': float((arrays['bets'] * arrays['house_loss'])[in_coin].max()),
+                'max_trial_loss': float(-lowest[:, index].min()),
+            },
+            'house_edge': expected_per_session / stake_per_session if stake_per_session else None,
+        }
+        if coin in bankrolls:
+            bankroll = float(bankrolls[coin])
+            coin_report['bankroll'] = bankroll
+            coin_report['risk_of_ruin'] = float((lowest[:, index] < -bankroll).mean())
+        report['coins'][coin] = coin_report
+    return report
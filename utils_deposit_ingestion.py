@@ -0,0 +1,199 @@
+"""
+Bulk ingestion of the blockchain deposits (utils/deposit_ingestion.py).
+
+Chain transactions are read by batches from a source (settings.DEPOSIT_SOURCE, dotted path;
+FileDepositSource reads JSON lines, for fixtures & replays) and each batch is ingested in one transaction:
+    - destination address -> Wallet with an in-memory index (no query per transaction)
+    - dedup on (blockchain, unique_trx_hash): one lookup per chain on the unique index
+    - bulk_create of the new User_Deposit rows
+    - one UPDATE for the counters & values of all the wallets of the batch
+    - one balance credit (guarded update + ledger entry) per user & coin
+So catching up after a downtime costs a few queries per batch instead of a few per deposit.
+"""
+import json
+import logging
+from collections import defaultdict, namedtuple
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Case, F, Value, When
+from django.utils.module_loading import import_string
+
+from core.models import Coin, Profile_User, User_Deposit, Wallet
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+DEPOSIT_SOURCE = getattr(settings, 'DEPOSIT_SOURCE', None) #dotted path of the live source (chain indexer client)
+DEPOSIT_BATCH_SIZE = getattr(settings, 'DEPOSIT_BATCH_SIZE', 1000)
+DEPOSIT_BATCH_RETRIES = 3 #a concurrent ingestor inserted some of the transactions first
+
+ChainTransaction = namedtuple('ChainTransaction', ['blockchain', 'trx_hash', 'coin_ticker', 'amount', 'from_addy', 'to_addy'])
+
+DEPOSITS = metrics.Counter('casino_deposits_total', 'Ingested chain transactions by outcome.')
+
+
+class BaseDepositSource:
+    """Interface of the deposit sources (chain indexer, node, file...)."""
+
+    def batches(self, batch_size):
+        """Yield lists of ChainTransaction."""
+        raise NotImplementedError
+
+    def commit(self, batch):
+        """The batch is ingested: a source can save its position here (block height, cursor...)."""
+
+
+class FileDepositSource(BaseDepositSource):
+    """JSON lines file: {blockchain, trx_hash, coin_ticker, amount, from, to} per line."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def batches(self, batch_size):
+        batch = []
+        with open(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                batch.append(ChainTransaction(
+                    blockchain=item['blockchain'],
+                    trx_hash=item['trx_hash'],
+                    coin_ticker=item['coin_ticker'],
+                    amount=item['amount'],
+                    from_addy=item.get('from'),
+                    to_addy=item['to'],
+                ))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+
+def get_deposit_source(*args, **kwargs):
+    """Source set in the settings."""
+    return import_string(DEPOSIT_SOURCE)(*args, **kwargs)
+
+
+class WalletIndex:
+    """(blockchain, address) -> (wallet id, user id) of the assigned wallets, loaded once.
+
+    Addresses missing from the index (assigned after the load) are looked up in one query per batch.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self.reload()
+
+    def reload(self):
+        self._index = self._load(Wallet.objects.filter(user__isnull=False))
+
+    @staticmethod
+    def _load(queryset):
+        return {(blockchain, address): (wallet_id, user_id) for wallet_id, user_id, blockchain, address
+                in queryset.values_list('id', 'user_id', 'blockchain', 'public_key').iterator()}
+
+    def resolve(self, keys):
+        """{(blockchain, address): (wallet id, user id)} for the known keys."""
+        missing = {key for key in keys if key not in self._index}
+        if missing:
+            addresses = {address for _, address in missing}
+            found = self._load(Wallet.objects.filter(user__isnull=False, public_key__in=addresses))
+            self._index.update(found)
+        return {key: self._index[key] for key in keys if key in self._index}
+
+
+def _amount(value):
+    try:
+        amount = Decimal(str(value))
+    except InvalidOperation:
+        return None
+    return amount if amount.is_finite() and amount > 0 else None
+
+
+def ingest_batch(batch, wallet_index):
+    """Ingest one batch of ChainTransaction, return the counts by outcome."""
+    stats = defaultdict(int)
+    stats['received'] = len(batch)
+    coins = Coin.registry()
+    wallets = wallet_index.resolve({(trx.blockchain, trx.to_addy) for trx in batch})
+
+    candidates = {}
+    for trx in batch:
+        amount = _amount(trx.amount)
+        if (trx.blockchain, trx.to_addy) not in wallets:
+            stats['unknown_address'] += 1
+        elif trx.coin_ticker not in coins or amount is None:
+            stats['invalid'] += 1
+            logger.warning("Invalid deposit %s %s: %s %s", trx.blockchain, trx.trx_hash, trx.amount, trx.coin_ticker)
+        elif (trx.blockchain, trx.trx_hash) in candidates:
+            stats['duplicate'] += 1
+        else:
+            candidates[(trx.blockchain, trx.trx_hash)] = (trx, amount)
+
+    for attempt in range(DEPOSIT_BATCH_RETRIES):
+        try:
+            with metrics.span('deposit_batch'), transaction.atomic():
+                inserted = _insert_new(candidates, wallets)
+            break
+        except IntegrityError:
+            #Same transaction inserted by another ingestor meanwhile: the batch was rolled back, dedup again
+            if attempt == DEPOSIT_BATCH_RETRIES - 1:
+                raise
+    stats['inserted'] = inserted
+    stats['duplicate'] += len(candidates) - inserted
+    for outcome in ('inserted', 'duplicate', 'unknown_address', 'invalid'):
+        DEPOSITS.inc(stats[outcome], outcome=outcome)
+    return dict(stats)
+
+
+def _insert_new(candidates, wallets):
+    by_chain = defaultdict(list)
+    for blockchain, trx_hash in candidates:
+        by_chain[blockchain].append(trx_hash)
+    existing = set()
+    for blockchain, hashes in by_chain.items():
+        existing.update((blockchain, trx_hash) for trx_hash in User_Deposit.objects.filter(
+            blockchain=blockchain, unique_trx_hash__in=hashes).values_list('unique_trx_hash', flat=True))
+
+    deposits = []
+    wallet_totals = defaultdict(lambda: [0, Decimal(0)]) #wallet id -> [deposits, value]
+    user_totals = defaultdict(Decimal) #(user id, coin) -> amount
+    for key, (trx, amount) in candidates.items():
+        if key in existing:
+            continue
+        wallet_id, user_id = wallets[(trx.blockchain, trx.to_addy)]
+        deposits.append(User_Deposit(
+            unique_trx_hash=trx.trx_hash, blockchain=trx.blockchain, coin_ticker=trx.coin_ticker, amount=amount,
+            from_addy=trx.from_addy, to_addy_id=wallet_id, user_id_id=user_id))
+        wallet_totals[wallet_id][0] += 1
+        wallet_totals[wallet_id][1] += amount
+        user_totals[(user_id, trx.coin_ticker)] += amount
+    if not deposits:
+        return 0
+
+    User_Deposit.objects.bulk_create(deposits)
+    Wallet.objects.filter(pk__in=wallet_totals).update(
+        counter_deposits=F('counter_deposits') + Case(
+            *[When(pk=wallet_id, then=Value(count)) for wallet_id, (count, _) in wallet_totals.items()]),
+        value_amount=F('value_amount') + Case(
+            *[When(pk=wallet_id, then=Value(value)) for wallet_id, (_, value) in wallet_totals.items()],
+            output_field=Wallet._meta.get_field('value_amount')),
+    )
+    profiles = Profile_User.objects.in_bulk({user_id for user_id, _ in user_totals}, field_name='user_id')
+    reference = str(len(deposits)) + ' deposits, last ' + deposits[-1].unique_trx_hash[:64]
+    for (user_id, coin_ticker), amount in user_totals.items():
+        profiles[user_id].deposit_funds_wallet(amount, coin_ticker, reference)
+    return len(deposits)
+
+
+def ingest(source, batch_size=DEPOSIT_BATCH_SIZE, wallet_index=None):
+    """Ingest every batch of a source, yield the counts of each batch."""
+    wallet_index = wallet_index or WalletIndex()
+    for batch in source.batches(batch_size):
+        stats = ingest_batch(batch, wallet_index)
+        source.commit(batch)
+        yield stats
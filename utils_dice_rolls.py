@@ -0,0 +1,104 @@
+"""
+Batched provably fair dice rolls (utils/dice_rolls.py).
+
+Same scheme as the single roll of provably_fair_dice.ProvablyFair:
+    HMAC-SHA512(key=server_seed, msg="client_seed-nonce")
+    -> first 5 hex chars of the digest that are < 10**6 (3 last chars otherwise)
+    -> roll = (lucky % 10**4) / 100   (0.00 - 99.99)
+
+Rolls are kept as integer hundredths in a compact array('H') so a whole
+flash bet (10k+ rolls) is one small buffer instead of one object per roll.
+check_parity() compares them with ProvablyFair.roll (check_roll_parity command, run on each deploy).
+"""
+import hmac
+import math
+from array import array
+from decimal import Decimal
+from hashlib import sha512
+
+ROLL_SCALE = 100 #rolls have 2 decimals
+ROLL_VALUES = 10000 #possible rolls: 0.00 -> 99.99
+PARITY_CHUNK = 1000 #nonces rolled per batch by check_parity
+
+
+def _lucky_number(hex_digest):
+    """Extract the roll (in hundredths) from the hex digest of one nonce."""
+    index = 0
+    while index + 5 <= len(hex_digest):
+        lucky = int(hex_digest[index:index + 5], 16)
+        if lucky < 10**6:
+            return lucky % ROLL_VALUES
+        index += 5
+    #Extremely unlikely: every chunk was >= 10**6, use the remaining chars
+    return int(hex_digest[index:], 16) % ROLL_VALUES
+
+
+def roll_range(server_seed, client_seed, nonce_start, count):
+    """Roll `count` dice for nonces [nonce_start, nonce_start+count).
+
+    The HMAC key schedule is computed once and copied for every nonce.
+    Returns an array('H') of rolls in hundredths (1234 == 12.34).
+    """
+    rolls = array('H')
+    if count <= 0:
+        return rolls
+    base = hmac.new(server_seed.encode(), digestmod=sha512)
+    prefix = (client_seed + '-')
+    for nonce in range(nonce_start, nonce_start + count):
+        h = base.copy()
+        h.update((prefix + str(nonce)).encode())
+        rolls.append(_lucky_number(h.hexdigest()))
+    return rolls
+
+
+def roll(server_seed, client_seed, nonce):
+    """Single roll, same code path as roll_range (so results are identical)."""
+    return hundredths_to_roll(roll_range(server_seed, client_seed, nonce, 1)[0])
+
+
+def hundredths_to_roll(value):
+    """Convert a roll stored in hundredths to the Decimal shown to users."""
+    return Decimal(value).scaleb(-2)
+
+
+def range_to_hundredths(min_range, max_range):
+    """Convert dice ranges to [lo, hi) bounds in hundredths.
+
+    For an integer r: min <= r/100  <=> r >= ceil(min*100)
+                      r/100 < max   <=> r <  ceil(max*100)
+    """
+    lo = math.ceil(Decimal(str(min_range)) * ROLL_SCALE)
+    hi = math.ceil(Decimal(str(max_range)) * ROLL_SCALE)
+    lo = min(max(lo, 0), ROLL_VALUES)
+    hi = min(max(hi, lo), ROLL_VALUES)
+    return lo, hi
+
+
+def win_mask(min_range, max_range):
+    """Lookup table (one byte per possible roll): 1 if the roll wins, else 0."""
+    lo, hi = range_to_hundredths(min_range, max_range)
+    return b'\x00' * lo + b'\x01' * (hi - lo) + b'\x00' * (ROLL_VALUES - hi)
+
+
+def check_parity(server_seed, client_seed, nonce_start, count, min_fallbacks=100):
+    """Compare roll_range with the single roll of provably_fair_dice.ProvablyFair, nonce by nonce.
+
+    The range goes past `count` nonces until at least `min_fallbacks` fallback digests (first
+    5 hex chars >= 10**6, roll taken from a later chunk) were compared.
+    Returns (rolls compared, fallback digests compared, mismatches [(nonce, batch roll, ProvablyFair roll)]).
+    """
+    from utils.provably_fair_dice import ProvablyFair
+    pfair = ProvablyFair(server_seed)
+    key = server_seed.encode()
+    compared, fallbacks, mismatches = 0, 0, []
+    start = nonce_start
+    while compared < count or fallbacks < min_fallbacks:
+        for nonce, value in enumerate(roll_range(server_seed, client_seed, start, PARITY_CHUNK), start):
+            expected = int(round(Decimal(str(pfair.roll(client_seed, nonce).roll)) * ROLL_SCALE))
+            if value != expected:
+                mismatches.append((nonce, str(hundredths_to_roll(value)), str(hundredths_to_roll(expected))))
+            if int(hmac.new(key, (client_seed + '-' + str(nonce)).encode(), sha512).hexdigest()[:5], 16) >= 10**6:
+                fallbacks += 1
+        compared += PARITY_CHUNK
+        start += PARITY_CHUNK
+    return compared, fallbacks, mismatches
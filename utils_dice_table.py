@@ -0,0 +1,74 @@
+"""
+Precomputed dice setups (utils/dice_table.py).
+
+user_winrate_choice has 2 decimals (0.01 -> 98.00) and a direction (roll under/over),
+so every possible result of dice_setup.compute_dice_setup (payout_X, min_range, max_range)
+is computed once when the module is loaded and looked up by index afterwards.
+The version (hash of the table) lets the frontend cache it and stay in sync with the server payouts.
+"""
+import json
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+from hashlib import sha256
+
+from utils import dice_setup
+
+MIN_CHOICE = 1 #0.01 % (in hundredths)
+MAX_CHOICE = 9800 #98.00 %
+
+DiceSetup = namedtuple('DiceSetup', ['payout_X', 'min_range', 'max_range'])
+
+
+def _index(hundredths, is_roll_under):
+    return (hundredths - MIN_CHOICE) * 2 + (1 if is_roll_under else 0)
+
+
+def _build_table():
+    table = []
+    for hundredths in range(MIN_CHOICE, MAX_CHOICE + 1):
+        choice = Decimal(hundredths).scaleb(-2)
+        for is_roll_under in (False, True): #same order as _index
+            params = dice_setup.compute_dice_setup(choice, is_roll_under)
+            table.append(DiceSetup(params.payout_X, params.min_range, params.max_range))
+    return tuple(table)
+
+
+def _to_hundredths(user_winrate_choice):
+    """0.01 steps only, ValueError otherwise."""
+    try:
+        hundredths = Decimal(str(user_winrate_choice)) * 100
+    except InvalidOperation:
+        raise ValueError('Invalid winrate choice')
+    if hundredths != hundredths.to_integral_value():
+        raise ValueError('Invalid winrate choice')
+    hundredths = int(hundredths)
+    if not MIN_CHOICE <= hundredths <= MAX_CHOICE:
+        raise ValueError('Winrate choice must be between 0.01 and 98')
+    return hundredths
+
+
+def get_dice_setup(user_winrate_choice, is_roll_under):
+    """Same result as dice_setup.compute_dice_setup, from the table (ValueError for invalid choices)."""
+    return TABLE[_index(_to_hundredths(user_winrate_choice), bool(is_roll_under))]
+
+
+def _serialize(table):
+    rows = {'roll_under': [], 'roll_over': []}
+    for hundredths in range(MIN_CHOICE, MAX_CHOICE + 1):
+        for is_roll_under, key in ((True, 'roll_under'), (False, 'roll_over')):
+            setup = table[_index(hundredths, is_roll_under)]
+            rows[key].append([str(setup.payout_X), str(setup.min_range), str(setup.max_range)])
+    body = {
+        'min_choice': str(Decimal(MIN_CHOICE).scaleb(-2)),
+        'max_choice': str(Decimal(MAX_CHOICE).scaleb(-2)),
+        'step': '0.01',
+        'columns': ['payout_X', 'min_range', 'max_range'],
+        **rows,
+    }
+    version = sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()[:16]
+    return version, json.dumps({'version': version, **body}, separators=(',', ':'))
+
+
+#Built once at startup
+TABLE = _build_table()
+VERSION, TABLE_JSON = _serialize(TABLE)
@@ -0,0 +1,281 @@
+"""
+Flash bet engine (utils/flash_bet_engine.py).
+
+Rolls and settlement of one flash bet, shared by the flash bet API (normal & streaming mode)
+and the flash bet workers (utils/flash_bet_jobs.py).
+    engine = FlashBetEngine(user, validated_data, profile, seed, casino)  #ValueError: invalid dice choice
+    engine.start()   #rotate revealed seed + reserve the nonces (ValueError: seed changed)
+    engine.roll(n)   #roll the next n bets (batch) and update the tally
+    engine.settle()  #save the FlashBet + one guarded balance update + history
+    engine.release() #always, once the settlement is over (or failed): the seed can be revealed again
+StrategyEngine: same flow for the saved dice strategies (bet changing after each roll).
+"""
+from array import array
+
+from django.conf import settings
+from django.db import transaction
+
+from core.models import FlashBet, BalanceLedger, BET_QUANTUM
+from utils import dice_rolls, dice_table, metrics
+from utils.history_writer import history_writer
+
+FLASH_BET_ROLL_HISTORY = getattr(settings, 'FLASH_BET_ROLL_HISTORY', False) #Save every roll of the flash bets in Game_Trx_historic (write-behind)
+FLASH_BET_ROLL_HISTORY_MAX = getattr(settings, 'FLASH_BET_ROLL_HISTORY_MAX', 10000) #... only up to this many rolls (bigger ones: FlashBet.expand_rolls)
+STRATEGY_ROLL_CHUNK = 10000 #rolls generated per batch by the strategy runs (they usually stop early)
+
+
+class FlashBetEngine:
+    """One flash bet: batched provably fair rolls, running tally and single settlement."""
+
+    def __init__(self, user, bet_data, profile, seed, casino):
+        self.user = user
+        self.bet_data = dict(bet_data)
+        self.profile = profile
+        self.seed = seed
+        self.casino = casino
+
+        self.number_of_bets = self.bet_data['number_of_bets']
+        self.bet_amount = self.bet_data['bet_amount']
+        self.coin_ticker = self.bet_data['coin_ticker']
+        #Dice setup (payouts and min max ranges for the dice - for current bet)
+        with metrics.span('dice_setup'):
+            self.dice_params = dice_table.get_dice_setup(self.bet_data['user_winrate_choice'], self.bet_data['is_roll_under'])
+            self.won_amount_after_fee = self.bet_amount * self.dice_params.payout_X - self.bet_amount #Value added in case user wins
+            self.mask = dice_rolls.win_mask(self.dice_params.min_range, self.dice_params.max_range)
+
+        self.server_seed = None
+        self.nonce_start = None
+        self.rolls = array('H')
+        self.winnings, self.losses = 0, 0
+        self.net_profit = 0
+        self.out_of_funds = False
+        self.flash_bet = None
+        self.lease = None #in flight lease of the seed (start -> release)
+
+    def start(self):
+        """New seed if the current one was revealed, then claim the nonces of the whole flash bet."""
+        with metrics.span('nonce_reserve'):
+            if self.seed.visible:
+                self.seed.modify_server_seed() #new seed taken from the pre-generated pool
+            #Rolls are keyed by the original (decrypted) server seed, the one shown to the user when revealed
+            self.server_seed = self.seed.decrypt_server_seed()
+            self.nonce_start = self.seed.reserve_nonces(self.number_of_bets)
+            #The seed is marked in flight: no reveal / new server seed until release()
+            self.lease = self.seed.begin_flash_bet()
+
+    def release(self):
+        """End of the flash bet, settled or not: remove the in flight lease of the seed (once)."""
+        if self.lease is not None:
+            self.seed.end_flash_bet(self.lease)
+            self.lease = None
+
+    @property
+    def rolls_done(self):
+        return len(self.rolls)
+
+    def balance(self):
+        """Funds of the user for the coin of the bet (before settlement)."""
+        return self.profile.get_balance(self.coin_ticker)
+
+    def roll(self, count, balance=None):
+        """Roll the next `count` bets of the reserved nonces and update the tally.
+
+        With `balance` (funds before the flash bet) it stops at the first bet the user can't afford.
+        """
+        with metrics.span('roll_loop'):
+            return self._roll(count, balance)
+
+    def _roll(self, count, balance):
+        count = min(count, self.number_of_bets - self.rolls_done)
+        chunk = dice_rolls.roll_range(self.server_seed, self.seed.client_seed, self.nonce_start + self.rolls_done, count)
+
+        if balance is not None:
+            available = balance + self.net_profit
+            #Only walk the chunk roll by roll when it could run out of funds inside it
+            if available - len(chunk) * self.bet_amount < 0 or self.won_amount_after_fee < 0:
+                for index, roll in enumerate(chunk):
+                    if available < self.bet_amount:
+                        chunk = chunk[:index]
+                        self.out_of_funds = True
+                        break
+                    available += self.won_amount_after_fee if self.mask[roll] else -self.bet_amount
+
+        wins = sum(map(self.mask.__getitem__, chunk))
+        self.winnings += wins
+        self.losses += len(chunk) - wins
+        self.net_profit = self.winnings * self.won_amount_after_fee - self.losses * self.bet_amount
+        self.rolls.extend(chunk)
+        return chunk
+
+    def progress(self):
+        return {
+            'rolls_done': self.rolls_done,
+            'number_of_bets': self.number_of_bets,
+            'winnings': self.winnings,
+            'losses': self.losses,
+            'net_profit': self.net_profit,
+            'coin_ticker': self.coin_ticker,
+        }
+
+    def settle(self):
+        """Save the FlashBet (rolls done only) and settle the net profit once (guarded update + ledger entry).
+
+        If the funds changed since the rolls (another bet settled meanwhile) and the guarded update fails,
+        the tally is cut at the first bet the locked balance can't cover and that part is settled:
+        the rolls are known to the user, a loss is never dropped.
+        """
+        try:
+            return self._settle()
+        except ValueError:
+            with transaction.atomic():
+                self._cut(self.profile.get_balance(self.coin_ticker, lock=True))
+                self.out_of_funds = True
+                return self._settle()
+
+    def _cut(self, balance):
+        """Keep the rolls up to the first bet `balance` can't cover and recompute the tally."""
+        available = balance
+        done = 0
+        for roll in self.rolls:
+            if available < self.bet_amount:
+                break
+            available += self.won_amount_after_fee if self.mask[roll] else -self.bet_amount
+            done += 1
+        del self.rolls[done:]
+        self.winnings = sum(map(self.mask.__getitem__, self.rolls))
+        self.losses = done - self.winnings
+        self.net_profit = self.winnings * self.won_amount_after_fee - self.losses * self.bet_amount
+
+    def _settle(self):
+        with metrics.span('settlement'), transaction.atomic():
+            flash_bet = FlashBet.objects.create(**{
+                **self.bet_data,
+                'user': self.user,
+                'number_of_bets': self.rolls_done,
+                'payout_multiplier': self.dice_params.payout_X,
+                'server_seed': self.seed.server_seed,
+                'hashed_server_seed': self.seed.hashed_server_seed_for_user,
+                'client_seed': self.seed.client_seed,
+                'nonce_start': self.nonce_start,
+            })
+            self.profile.apply_delta(self.net_profit, self.coin_ticker, BalanceLedger.REASON_FLASH_BET,
+                                     reference=flash_bet.pk, casino_ref=self.casino)
+        self.flash_bet = flash_bet
+        transaction.on_commit(self._committed)
+        return flash_bet
+
+    def _committed(self):
+        """After the settlement commit: counters & per roll history."""
+        metrics.FLASH_BETS.inc(coin=self.coin_ticker)
+        metrics.ROLLS.inc(self.winnings, coin=self.coin_ticker, outcome='win')
+        metrics.ROLLS.inc(self.losses, coin=self.coin_ticker, outcome='loss')
+        if FLASH_BET_ROLL_HISTORY and self.rolls_done <= FLASH_BET_ROLL_HISTORY_MAX:
+            #Per roll history is written in background by batches (one compact item per flash bet is queued here),
+            #once the flash bet is committed (settle() can run inside a bigger transaction)
+            with metrics.span('history_save'):
+                self._enqueue_history()
+
+    def _history_fields(self):
+        """Fields shared by the history rows of the rolls."""
+        return {
+            'user_winrate_choice': self.bet_data['user_winrate_choice'],
+            'is_roll_under': self.bet_data['is_roll_under'],
+            'bet_amount': self.bet_amount,
+            'coin_ticker': self.coin_ticker,
+            'flash_bet_id': self.flash_bet.pk,
+            'description': 'Flash bet ' + str(self.flash_bet.pk),
+        }
+
+    def _enqueue_history(self):
+        history_writer.enqueue_rolls(
+            self.user.id, self.nonce_start, self.rolls,
+            self.dice_params.min_range, self.dice_params.max_range,
+            self.dice_params.payout_X, **self._history_fields())
+
+
+class StrategyEngine(FlashBetEngine):
+    """Run of a saved Dice_Custom_Strategies: the bet changes after each roll (on win / on loss rules)
+    until number_of_rolls, the stop loss / take profit, or the funds of the user are reached.
+
+    Same flow as a flash bet (start, roll, settle once), the rolls are still generated by batches
+    but the tally is walked roll by roll since every bet depends on the previous outcome.
+    """
+
+    def __init__(self, user, strategy, profile, seed, casino, number_of_rolls=None):
+        super().__init__(user, strategy.bet_data(number_of_rolls), profile, seed, casino)
+        #Saved strategies don't go through the flash bet serializer: same checks on the base bet
+        if not self.bet_amount > 0 or self.bet_amount != self.bet_amount.quantize(BET_QUANTUM):
+            raise ValueError('Invalid bet amount for this strategy')
+        self.strategy = strategy
+        self.current_bet = self.bet_amount
+        self.bet_amounts = [] #bet of each roll done
+        self.profits = [] #net profit after each roll
+        self.stop_reason = None
+
+    def run(self, balance=None, chunk_size=STRATEGY_ROLL_CHUNK):
+        """Roll until the end of the strategy (batches of chunk_size rolls)."""
+        while self.rolls_done < self.number_of_bets and self.stop_reason is None:
+            self.roll(chunk_size, balance)
+        return self.stop_reason or 'completed'
+
+    def _roll(self, count, balance):
+        count = min(count, self.number_of_bets - self.rolls_done)
+        chunk = dice_rolls.roll_range(self.server_seed, self.seed.client_seed, self.nonce_start + self.rolls_done, count)
+        payout_gain = self.dice_params.payout_X - 1
+        done = 0
+        for roll in chunk:
+            bet = self.current_bet
+            if bet <= 0: #multiplier of a strategy saved without validation
+                self.stop_reason = 'invalid_bet'
+                break
+            if balance is not None and balance + self.net_profit < bet:
+                self.out_of_funds = True
+                self.stop_reason = 'out_of_funds'
+                break
+            won = self.mask[roll]
+            if won:
+                self.winnings += 1
+                self.net_profit += bet * payout_gain
+            else:
+                self.losses += 1
+                self.net_profit -= bet
+            self.bet_amounts.append(bet)
+            self.profits.append(self.net_profit)
+            self.current_bet = self.strategy.next_bet(bet, won)
+            done += 1
+            self.stop_reason = self.strategy.stop_reason(self.net_profit)
+            if self.stop_reason is not None:
+                break
+        chunk = chunk[:done]
+        self.rolls.extend(chunk)
+        return chunk
+
+    def _cut(self, balance):
+        done = 0
+        for bet in self.bet_amounts:
+            if balance + (self.profits[done - 1] if done else 0) < bet:
+                break
+            done += 1
+        del self.rolls[done:], self.bet_amounts[done:], self.profits[done:]
+        self.winnings = sum(map(self.mask.__getitem__, self.rolls))
+        self.losses = done - self.winnings
+        self.net_profit = self.profits[-1] if done else 0
+        self.stop_reason = 'out_of_funds'
+
+    def progress(self):
+        return {**super().progress(), 'stop_reason': self.stop_reason or 'completed', 'next_bet': self.current_bet}
+
+    def summary(self):
+        """Per roll summary: [nonce, roll, bet_amount, is_winner, net_profit] for each roll done."""
+        return [
+            [nonce, dice_rolls.hundredths_to_roll(roll), bet, bool(self.mask[roll]), profit]
+            for nonce, (roll, bet, profit) in enumerate(zip(self.rolls, self.bet_amounts, self.profits), self.nonce_start)
+        ]
+
+    def _enqueue_history(self):
+        fields = self._history_fields()
+        fields['description'] = self.bet_data['description'] + ' (flash bet ' + str(self.flash_bet.pk) + ')'
+        history_writer.enqueue_rolls(
+            self.user.id, self.nonce_start, self.rolls,
+            self.dice_params.min_range, self.dice_params.max_range,
+            self.dice_params.payout_X, bet_amounts=list(self.bet_amounts), **fields)
@@ -0,0 +1,233 @@
+"""
+Background jobs for the big flash bets (utils/flash_bet_jobs.py).
+
+process_flash_bet enqueues the flash bets above FLASH_BET_JOB_THRESHOLD bets and returns the job id;
+the workers (run_flash_bet_workers command) run them with the same FlashBetEngine as the API.
+Jobs of one user run one at a time and in order, so the nonces of a seed are never consumed concurrently.
+A running job is leased: its worker sends a heartbeat every FLASH_BET_JOB_HEARTBEAT seconds and the jobs
+without heartbeat for FLASH_BET_JOB_LEASE seconds are requeued (only the attempt that claimed a job can complete it).
+
+The queue backend is set by settings.FLASH_BET_JOB_QUEUE (dotted path), the default one is
+a DB table (FlashBetJob) that works without any external broker.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+
+from core.models import FlashBetJob, Casino_Bankroll, Seed
+from utils import flash_bet_engine
+
+logger = logging.getLogger(__name__)
+
+FLASH_BET_JOB_THRESHOLD = getattr(settings, 'FLASH_BET_JOB_THRESHOLD', 100000) #number_of_bets above which a flash bet is a job
+FLASH_BET_MAX_JOBS_PER_USER = getattr(settings, 'FLASH_BET_MAX_JOBS_PER_USER', 3) #pending + running jobs
+FLASH_BET_JOB_QUEUE = getattr(settings, 'FLASH_BET_JOB_QUEUE', 'utils.flash_bet_jobs.DatabaseJobQueue')
+FLASH_BET_JOB_LEASE = getattr(settings, 'FLASH_BET_JOB_LEASE', 120) #seconds without heartbeat before a running job is considered lost
+FLASH_BET_JOB_HEARTBEAT = getattr(settings, 'FLASH_BET_JOB_HEARTBEAT', 10) #seconds between two heartbeats of a worker
+FLASH_BET_JOB_CHUNK = 100000 #rolls between two heartbeat checks
+
+DECIMAL_FIELDS = ('bet_amount', 'user_winrate_choice', 'payout_multiplier')
+
+
+class JobQueueFull(Exception):
+    """Too many jobs in flight for this user."""
+
+
+class JobLeaseLost(Exception):
+    """The job was requeued (lease expired) or claimed again: this attempt must not complete it."""
+
+
+class BaseJobQueue:
+    """Interface of the flash bet job queues."""
+
+    def enqueue(self, user, bet_data):
+        """Add a job, return its id (JobQueueFull if the user has too many jobs in flight)."""
+        raise NotImplementedError
+
+    def claim(self):
+        """Next job to run (marked running) or None."""
+        raise NotImplementedError
+
+    def heartbeat(self, job):
+        """Extend the lease of a running job (JobLeaseLost if it was requeued)."""
+
+    def complete(self, job, result, flash_bet=None):
+        """Mark the job done (JobLeaseLost if this attempt lost it: the settlement must roll back)."""
+        raise NotImplementedError
+
+    def fail(self, job, error):
+        raise NotImplementedError
+
+    def get(self, user, job_id):
+        """Job of this user (for the status endpoint) or None."""
+        raise NotImplementedError
+
+    def requeue_stale(self):
+        """Put back the jobs of dead workers, return how many."""
+        return 0
+
+
+class DatabaseJobQueue(BaseJobQueue):
+    """Job queue in the FlashBetJob table (select ... for update skip locked)."""
+
+    def enqueue(self, user, bet_data):
+        with transaction.atomic():
+            #Lock the seed row of the user so the in flight count can't be raced
+            Seed.objects.select_for_update().filter(user=user).first()
+            in_flight = FlashBetJob.objects.filter(
+                user=user, status__in=[FlashBetJob.STATUS_PENDING, FlashBetJob.STATUS_RUNNING]).count()
+            if in_flight >= FLASH_BET_MAX_JOBS_PER_USER:
+                raise JobQueueFull('Too many flash bets in progress (max ' + str(FLASH_BET_MAX_JOBS_PER_USER) + ')')
+            return FlashBetJob.objects.create(user=user, bet_data=dump_bet_data(bet_data)).pk
+
+    def claim(self):
+        with transaction.atomic():
+            running_users = FlashBetJob.objects.filter(status=FlashBetJob.STATUS_RUNNING).values('user_id')
+            job = (FlashBetJob.objects.select_for_update(skip_locked=True)
+                   .filter(status=FlashBetJob.STATUS_PENDING).exclude(user_id__in=running_users)
+                   .order_by('id').first())
+            if job is None:
+                return None
+            #Claims of one user are serialized on his seed row: at most one running job per user, oldest first
+            Seed.objects.select_for_update().filter(user_id=job.user_id).first()
+            if FlashBetJob.objects.filter(user_id=job.user_id, status=FlashBetJob.STATUS_RUNNING).exists():
+                return None
+            oldest = (FlashBetJob.objects.filter(user_id=job.user_id, status=FlashBetJob.STATUS_PENDING)
+                      .order_by('id').values_list('id', flat=True).first())
+            if oldest != job.pk:
+                return None #the older one is being claimed by another worker
+            job.status = FlashBetJob.STATUS_RUNNING
+            job.started_at = job.heartbeat_at = now()
+            job.attempt += 1
+            job.save(update_fields=['status', 'started_at', 'heartbeat_at', 'attempt'])
+            return job
+
+    def _current(self, job):
+        """The job row while it is still run by this attempt."""
+        return FlashBetJob.objects.filter(pk=job.pk, status=FlashBetJob.STATUS_RUNNING, attempt=job.attempt)
+
+    def heartbeat(self, job):
+        if not self._current(job).update(heartbeat_at=now()):
+            raise JobLeaseLost('Flash bet job ' + str(job.pk) + ' was requeued')
+
+    def complete(self, job, result, flash_bet=None):
+        if not self._current(job).update(status=FlashBetJob.STATUS_DONE, result=result, flash_bet=flash_bet, finished_at=now()):
+            raise JobLeaseLost('Flash bet job ' + str(job.pk) + ' was requeued')
+
+    def fail(self, job, error):
+        #No-op when the job was requeued: the new attempt owns it
+        self._current(job).update(status=FlashBetJob.STATUS_FAILED, error=str(error), finished_at=now())
+
+    def get(self, user, job_id):
+        return FlashBetJob.objects.filter(user=user, pk=job_id).first()
+
+    def requeue_stale(self):
+        #Only the jobs without heartbeat for a whole lease (dead worker). A job is settled & completed in the same
+        #transaction and complete() only matches the current attempt, so a slow worker of a requeued job settles nothing
+        return FlashBetJob.objects.filter(
+            status=FlashBetJob.STATUS_RUNNING, heartbeat_at__lt=now() - timedelta(seconds=FLASH_BET_JOB_LEASE),
+        ).update(status=FlashBetJob.STATUS_PENDING, started_at=None, heartbeat_at=None)
+
+
+def get_job_queue():
+    """Queue backend set in the settings."""
+    return import_string(FLASH_BET_JOB_QUEUE)()
+
+
+def dump_bet_data(bet_data):
+    """Validated data of the request -> JSON (decimals as strings)."""
+    return {key: str(value) if isinstance(value, Decimal) else value for key, value in bet_data.items()}
+
+
+def load_bet_data(data):
+    return {key: Decimal(value) if key in DECIMAL_FIELDS else value for key, value in data.items()}
+
+
+def run_job(job, job_queue):
+    """Execute one flash bet job with the FlashBetEngine (settlement and job completion in one transaction)."""
+    engine = None
+    try:
+        #Seed & profile locked while the seed is rotated and the nonces reserved (same as the API)
+        with transaction.atomic():
+            seed = Seed.load_for_user(job.user_id, lock=True)
+            if seed is None:
+                raise ValueError('No seed for this user')
+            engine = flash_bet_engine.FlashBetEngine(
+                job.user, load_bet_data(job.bet_data), seed.user.profile_user, seed, Casino_Bankroll.get_cached())
+            engine.start()
+        #Stops at the first bet the user can't afford: only the rolls done are settled.
+        #Rolled by chunks to keep the lease of the job while the worker is alive
+        balance = engine.balance()
+        last_beat = time.monotonic()
+        while engine.rolls_done < engine.number_of_bets and not engine.out_of_funds:
+            engine.roll(FLASH_BET_JOB_CHUNK, balance)
+            if time.monotonic() - last_beat >= FLASH_BET_JOB_HEARTBEAT:
+                job_queue.heartbeat(job)
+                last_beat = time.monotonic()
+        with transaction.atomic():
+            flash_bet = engine.settle()
+            job_queue.complete(job, dump_bet_data({
+                'status': 'stopped' if engine.out_of_funds else 'success',
+                **engine.progress(),
+            }), flash_bet)
+    except ValueError as e:
+        job_queue.fail(job, e)
+    finally:
+        if engine is not None:
+            engine.release()
+
+
+class FlashBetWorkerPool:
+    """Local pool of worker threads claiming and running the flash bet jobs."""
+
+    def __init__(self, workers=2, poll_interval=1.0, job_queue=None):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.job_queue = job_queue or get_job_queue()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name='flash-bet-worker-' + str(index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Finish the running jobs and stop."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _work(self):
+        while not self._stop.is_set():
+            job = None
+            try:
+                job = self.job_queue.claim()
+                if job is not None:
+                    run_job(job, self.job_queue)
+            except JobLeaseLost as e:
+                logger.warning("Flash bet job dropped: %s", e)
+            except Exception as e:
+                logger.exception("Flash bet worker error: %s", e)
+                if job is not None:
+                    self.job_queue.fail(job, e)
+            finally:
+                close_old_connections()
+            if job is None:
+                self._stop.wait(self.poll_interval)
+
+    def requeue_stale_forever(self, interval=60):
+        """Blocking loop putting back the lost jobs (run by the command in the main thread)."""
+        while not self._stop.wait(interval):
+            requeued = self.job_queue.requeue_stale()
+            if requeued:
+                logger.warning("Flash bet jobs requeued: %s", requeued)
+            close_old_connections()
@@ -0,0 +1,140 @@
+"""
+Write-behind writer for the per-roll history of the bets (utils/history_writer.py).
+
+The request path only enqueues one compact item per flash bet
+    (user_id, nonce_start, rolls, min_range, max_range, payout_multiplier, bet_fields, bet_amounts)
+in a bounded queue; a background thread drains it and bulk_creates the
+Game_Trx_historic rows (one per roll) by batches of rows.
+A batch is flushed when it is full, when FLUSH_INTERVAL seconds passed, and on shutdown.
+If the queue is full the flash bet is dropped (its rolls counted) instead of blocking the bet.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+
+from core.models import Game_Trx_historic
+from utils import dice_rolls, metrics
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = getattr(settings, 'HISTORY_WRITER_QUEUE_SIZE', 10000) #flash bets waiting to be written
+BATCH_SIZE = getattr(settings, 'HISTORY_WRITER_BATCH_SIZE', 5000) #rows per bulk insert
+FLUSH_INTERVAL = getattr(settings, 'HISTORY_WRITER_FLUSH_INTERVAL', 1.0) #seconds
+
+
+class HistoryWriter:
+    """Bounded queue + background thread doing bulk inserts of Game_Trx_historic."""
+
+    def __init__(self, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the background thread (done lazily by the first enqueue)."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=30):
+        """Flush what is left in the queue and stop the thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def enqueue_rolls(self, user_id, nonce_start, rolls, min_range, max_range, payout_multiplier, bet_amounts=None, **bet_fields):
+        """Enqueue every roll of a flash bet as one item (rolls in hundredths, see dice_rolls.roll_range).
+
+        bet_fields (bet_amount, coin_ticker...) are shared by all the rolls of the bet;
+        bet_amounts: bet of each roll when it changes (strategies).
+        Returns the number of dropped rolls (all of them if the queue is full).
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        try:
+            self.queue.put_nowait((user_id, nonce_start, rolls, min_range, max_range, payout_multiplier, bet_fields, bet_amounts))
+        except queue.Full:
+            with self._lock:
+                self.dropped += len(rolls)
+            return len(rolls)
+        return 0
+
+    def metrics(self):
+        """Counters of the writer (queue depth, dropped/written/failed records)."""
+        return {
+            'queue_depth': self.queue.qsize(),
+            'dropped': self.dropped,
+            'written': self.written,
+            'failed': self.failed,
+        }
+
+    def _run(self):
+        batch = []
+        rows = 0
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                batch.append(item)
+                rows += len(item[2])
+            except queue.Empty:
+                pass
+            stopping = self._stop.is_set()
+            if rows >= self.batch_size or time.monotonic() >= deadline or stopping:
+                if stopping:
+                    #Shutdown: drain everything left
+                    while True:
+                        try:
+                            batch.append(self.queue.get_nowait())
+                        except queue.Empty:
+                            break
+                self._flush(batch)
+                batch = []
+                rows = 0
+                deadline = time.monotonic() + self.flush_interval
+                if stopping:
+                    return
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        objs = []
+        for user_id, nonce_start, rolls, min_range, max_range, payout_multiplier, bet_fields, bet_amounts in batch:
+            mask = dice_rolls.win_mask(min_range, max_range)
+            for index, roll in enumerate(rolls):
+                fields = bet_fields if bet_amounts is None else {**bet_fields, 'bet_amount': bet_amounts[index]}
+                objs.append(Game_Trx_historic(
+                    user_id=user_id, nonce=nonce_start + index, rolled_dice=dice_rolls.hundredths_to_roll(roll),
+                    is_winner=bool(mask[roll]), payout_multiplier=payout_multiplier, **fields))
+        try:
+            with metrics.span('history_flush'):
+                Game_Trx_historic.objects.bulk_create(objs, batch_size=self.batch_size)
+            with self._lock:
+                self.written += len(objs)
+        except DatabaseError as e:
+            logger.exception("History writer error: %s", e)
+            with self._lock:
+                self.failed += len(objs)
+        finally:
+            close_old_connections()
+
+
+#Process wide writer used by the views
+history_writer = HistoryWriter()
+metrics.register_gauges('casino_history_writer', 'Roll history writer: queue depth & dropped/written/failed records.',
+                        lambda: {(('kind', name),): value for name, value in history_writer.metrics().items()})
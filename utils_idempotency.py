@@ -0,0 +1,123 @@
+"""
+Idempotency keys of the betting endpoints (utils/idempotency.py).
+
+A request sent with an `Idempotency-Key` header runs once per user & key:
+    - the first one inserts the key (unique user/key) and runs; its response is stored
+    - a retry with the same key gets the stored response (header Idempotent-Replayed: true), nothing is recomputed
+    - a duplicate arriving while the first one runs waits for its response (IDEMPOTENCY_WAIT seconds, then 409)
+    - a key still in progress after IDEMPOTENCY_LEASE seconds (process lost) is taken over by the next retry;
+      the late first request, if still alive, doesn't store its response anymore
+    - the same key with another body is refused (422)
+Server errors and transient refusals (409/429) are not stored, so the client can retry them.
+Keys are kept IDEMPOTENCY_TTL seconds (sweep_idempotency_keys command).
+"""
+import hashlib
+import json
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction, IntegrityError
+from django.http import HttpResponse
+from django.utils.timezone import now
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from core.models import IdempotencyKey
+from utils import metrics
+
+IDEMPOTENCY_TTL = getattr(settings, 'IDEMPOTENCY_TTL', 86400) #seconds a key (and its response) is kept
+IDEMPOTENCY_WAIT = getattr(settings, 'IDEMPOTENCY_WAIT', 30) #seconds a duplicate waits for the first request
+IDEMPOTENCY_LEASE = getattr(settings, 'IDEMPOTENCY_LEASE', 120) #seconds a key stays in progress before a retry can take it over
+IDEMPOTENCY_POLL = 0.05 #seconds between two checks of a key in progress in another process
+KEY_MAX_LENGTH = 100
+NOT_STORED_STATUSES = (status.HTTP_409_CONFLICT, status.HTTP_429_TOO_MANY_REQUESTS)
+
+REPLAYS = metrics.Counter('casino_idempotent_replays_total', 'Requests answered with a stored response by endpoint.')
+
+#Keys running in this process: duplicates wake up as soon as the response is stored
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def request_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+
+
+def _error(message, code):
+    return Response({'status': 'error', 'message': message}, status=code)
+
+
+def _replay(record, endpoint):
+    """The stored response, same bytes as the first one (Decimals stay JSON numbers)."""
+    REPLAYS.inc(endpoint=endpoint)
+    response = HttpResponse(bytes(record.response_body), status=record.response_status, content_type='application/json')
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def execute(user, key, data, func, endpoint='flash_bet'):
+    """Response of func() for this user & key: computed once, replayed afterwards."""
+    if not key or len(key) > KEY_MAX_LENGTH:
+        return _error('Invalid Idempotency-Key (1 to ' + str(KEY_MAX_LENGTH) + ' characters)', status.HTTP_400_BAD_REQUEST)
+    body_hash = request_hash(data)
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    while True:
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(user=user, key=key, request_hash=body_hash)
+            break #first request with this key: run it
+        except IntegrityError:
+            record = IdempotencyKey.objects.filter(user=user, key=key).first()
+        if record is None:
+            continue #the first request failed and released the key: run it here
+        if record.status == IdempotencyKey.STATUS_IN_PROGRESS and record.created_at < now() - timedelta(seconds=IDEMPOTENCY_LEASE):
+            #Lease expired: take the key over (one retry wins the conditional update)
+            taken_at = now()
+            if IdempotencyKey.objects.filter(pk=record.pk, status=IdempotencyKey.STATUS_IN_PROGRESS,
+                                             created_at=record.created_at).update(created_at=taken_at, request_hash=body_hash):
+                record.created_at, record.request_hash = taken_at, body_hash
+                break
+            continue
+        if record.request_hash != body_hash:
+            return _error('Idempotency-Key already used with another request', status.HTTP_422_UNPROCESSABLE_ENTITY)
+        if record.status == IdempotencyKey.STATUS_DONE:
+            return _replay(record, endpoint)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return _error('A request with this Idempotency-Key is still in progress', status.HTTP_409_CONFLICT)
+        event = _in_flight.get((user.pk, key))
+        if event is not None:
+            event.wait(remaining)
+        else:
+            time.sleep(min(IDEMPOTENCY_POLL, remaining))
+
+    event = threading.Event()
+    with _in_flight_lock:
+        _in_flight[(user.pk, key)] = event
+    #Only while we still hold the lease (not taken over by a retry)
+    owned = IdempotencyKey.objects.filter(pk=record.pk, status=IdempotencyKey.STATUS_IN_PROGRESS, created_at=record.created_at)
+    try:
+        response = func()
+        if response.status_code >= 500 or response.status_code in NOT_STORED_STATUSES:
+            owned.delete()
+        else:
+            owned.update(status=IdempotencyKey.STATUS_DONE, response_status=response.status_code,
+                         response_body=JSONRenderer().render(response.data))
+        return response
+    except Exception:
+        owned.delete()
+        raise
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop((user.pk, key), None)
+        event.set()
+
+
+def sweep(ttl=IDEMPOTENCY_TTL):
+    """Delete the keys older than ttl seconds, return how many."""
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=now() - timedelta(seconds=ttl)).delete()
+    return deleted
@@ -0,0 +1,151 @@
+"""
+Hot path metrics (utils/metrics.py): counters, latency histograms and timed spans,
+exported in the Prometheus text format by metrics_view (bearer token: settings.METRICS_TOKEN).
+
+    with metrics.span('roll_loop'):
+        ...
+    metrics.FLASH_BETS.inc(coin='ETH')
+
+Everything is in process memory (one lock per metric), cheap enough to stay on in production.
+"""
+import bisect
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+METRICS_TOKEN = getattr(settings, 'METRICS_TOKEN', None) #scraper token (Authorization: Bearer <token>)
+METRICS_ALLOWED_IPS = getattr(settings, 'METRICS_ALLOWED_IPS', ('127.0.0.1', '::1')) #without token: direct local requests only
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+_callbacks = []
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    """Monotonic counter with labels."""
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name, self.help_text = name, help_text
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name + _format_labels(key), value) for key, value in self._values.items()]
+
+
+class Histogram:
+    """Latency histogram with labels (cumulative buckets, sum & count)."""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name, self.help_text = name, help_text
+        self.buckets = tuple(buckets)
+        self._values = {} #labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = _labels_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                data[index] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(data)) for key, data in self._values.items()]
+        samples = []
+        for key, data in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                samples.append((self.name + '_bucket' + _format_labels(key, [('le', bound)]), cumulative))
+            samples.append((self.name + '_bucket' + _format_labels(key, [('le', '+Inf')]), data[-1]))
+            samples.append((self.name + '_sum' + _format_labels(key), data[-2]))
+            samples.append((self.name + '_count' + _format_labels(key), data[-1]))
+        return samples
+
+
+def register_gauges(name, help_text, func):
+    """Gauge read at export time: func() returns {labels tuple or (): value} or a number."""
+    _callbacks.append((name, help_text, func))
+
+
+#Hot path metrics
+SPANS = Histogram('casino_span_seconds', 'Duration of the named steps of the hot paths.')
+FLASH_BET_LATENCY = Histogram('casino_flash_bet_seconds', 'Duration of process_flash_bet by coin.')
+FLASH_BETS = Counter('casino_flash_bets_total', 'Settled flash bets by coin.')
+ROLLS = Counter('casino_rolls_total', 'Settled rolls by coin and outcome.')
+FLASH_BET_ERRORS = Counter('casino_flash_bet_errors_total', 'Refused or failed flash bets by reason.')
+
+
+@contextmanager
+def span(name):
+    """Time a named step of a hot path (casino_span_seconds{span=name})."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPANS.observe(time.perf_counter() - start, span=name)
+
+
+def render_prometheus():
+    """All the metrics in the Prometheus text format (version 0.0.4)."""
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.help_text}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(f'{sample} {value}' for sample, value in metric.samples())
+    for name, help_text, func in _callbacks:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        values = func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        lines.extend(f'{name}{_format_labels(key)} {value}' for key, value in values.items())
+    return '\n'.join(lines) + '\n'
+
+
+def _scrape_allowed(request):
+    if METRICS_TOKEN:
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+    #No token set: only a local scraper talking to the app server directly (behind a reverse proxy every
+    #request comes from 127.0.0.1, the forwarding headers tell them apart)
+    return (request.META.get('REMOTE_ADDR') in METRICS_ALLOWED_IPS
+            and 'HTTP_X_FORWARDED_FOR' not in request.META and 'HTTP_X_REAL_IP' not in request.META)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint (bearer token, or direct local requests when no token is set)."""
+    if not _scrape_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
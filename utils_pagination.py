@@ -0,0 +1,61 @@
+"""
+Keyset pagination of the history listings (utils/pagination.py).
+
+    GET flash_bets/?page_size=50&date_from=2024-01-01&date_to=2024-02-01&compact=1
+    -> {"next": "...?cursor=...", "previous": ..., "results": [...]}
+
+The cursor holds the last id seen, each page is one `WHERE user = .. AND id < cursor ORDER BY id DESC LIMIT n`
+on the (user, id DESC) index: the cost of a page doesn't depend on the length of the history (no OFFSET, no COUNT).
+"""
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
+
+HISTORY_PAGE_SIZE = getattr(settings, 'HISTORY_PAGE_SIZE', 50)
+HISTORY_MAX_PAGE_SIZE = getattr(settings, 'HISTORY_MAX_PAGE_SIZE', 500)
+
+
+class KeysetPagination(CursorPagination):
+    """Cursor pagination on the primary key (newest first)."""
+    ordering = '-id'
+    page_size = HISTORY_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = HISTORY_MAX_PAGE_SIZE
+
+
+def _parse_bound(value, name):
+    try:
+        parsed = parse_datetime(value) or parse_date(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValidationError({name: 'Invalid date (YYYY-MM-DD or ISO 8601 datetime)'})
+    return parsed
+
+
+def filter_date_range(queryset, params, field='date_game'):
+    """Optional ?date_from= & ?date_to= (inclusive dates or datetimes) on `field`.
+
+    Plain dates become aware datetimes (start of the day, start of the next day for date_to),
+    so the filter is a plain range on the column and its index, not a __date cast of every row.
+    """
+    for name, lookup in (('date_from', 'gte'), ('date_to', 'lte')):
+        if params.get(name):
+            bound = _parse_bound(params[name], name)
+            if not isinstance(bound, datetime):
+                if name == 'date_to':
+                    bound, lookup = bound + timedelta(days=1), 'lt'
+                bound = datetime.combine(bound, time.min)
+            if settings.USE_TZ and timezone.is_naive(bound):
+                bound = timezone.make_aware(bound)
+            queryset = queryset.filter(**{field + '__' + lookup: bound})
+    return queryset
+
+
+def is_compact(request):
+    """?compact=1: list without the heavy text fields."""
+    return str(request.query_params.get('compact', '')).lower() in ('1', 'true')
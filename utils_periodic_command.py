@@ -0,0 +1,38 @@
+"""
+Base of the maintenance commands that run once (cron) or as a background worker (utils/periodic_command.py).
+
+    class Command(PeriodicCommand):
+        default_interval = 30
+        def run_once(self, **options): ...
+
+    python manage.py <command>                         #once
+    python manage.py <command> --loop --interval 30    #every 30 seconds
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+
+class PeriodicCommand(BaseCommand):
+    """Adds --loop / --interval and runs run_once() once or every interval (DB connections recycled in between)."""
+    default_interval = 60 #seconds between two runs (--loop)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep running and run again every interval.')
+        parser.add_argument('--interval', type=float, default=self.default_interval, help='Seconds between two runs (--loop).')
+
+    def setup(self, **options):
+        """Called once before the first run (load the backends, CommandError on bad configuration)."""
+
+    def run_once(self, **options):
+        raise NotImplementedError
+
+    def handle(self, *args, **options):
+        self.setup(**options)
+        while True:
+            self.run_once(**options)
+            if not options['loop']:
+                break
+            close_old_connections()
+            time.sleep(options['interval'])
@@ -0,0 +1,236 @@
+"""
+Read-through cache of the public seed state (utils/seed_cache.py).
+
+The state polled by the client (hashed server seed, client seed, nonce, visible) is served from
+the cache (Seed.public_state) and deleted by every change of the seed: new server/client seed,
+reveal and nonce reservations (Seed model), so the Seed table is only read after a change.
+
+Backend set by settings.SEED_CACHE_BACKEND (dotted path):
+    - LocalLRUCache: in process memory, for a single process (other processes only see changes after the TTL)
+    - FileCache (default): one small file per user in a shared directory (/dev/shm when available),
+      shared by all the processes of a host; stale files are deleted when read and by a bounded sweep
+    - DjangoCache: the Django cache (Redis, memcached...), for several hosts
+Entries are versioned by a generation bumped by each invalidation, so a row read before a change
+and stored after it is never served; SEED_CACHE_TTL bounds how long a missed invalidation can be served.
+"""
+import json
+import os
+import random
+import secrets
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+SEED_CACHE_BACKEND = getattr(settings, 'SEED_CACHE_BACKEND', 'utils.seed_cache.FileCache')
+SEED_CACHE_TTL = getattr(settings, 'SEED_CACHE_TTL', 60) #seconds
+SEED_CACHE_SIZE = getattr(settings, 'SEED_CACHE_SIZE', 100000) #entries of the in-process LRU
+SEED_CACHE_DIR = getattr(settings, 'SEED_CACHE_DIR', os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'casino_seed_cache'))
+SEED_CACHE_SWEEP_EVERY = getattr(settings, 'SEED_CACHE_SWEEP_EVERY', 1000) #FileCache: writes between two sweeps of a process
+SEED_CACHE_SWEEP_MAX = getattr(settings, 'SEED_CACHE_SWEEP_MAX', 500) #... files checked per sweep
+FILE_CACHE_BUCKETS = 256 #sub directories of the FileCache (user id % 256), one is swept at a time
+
+
+class BaseSeedCache:
+    """Interface of the seed state caches (keyed by user id).
+
+    Entries are versioned: delete() gives the user a new generation, and an entry stored with an older
+    generation is never served. A reader takes generation() before reading the row, so a row read before
+    an invalidation and stored after it is ignored (instead of being served for the whole TTL).
+    """
+
+    def get(self, user_id):
+        """Cached state or None."""
+        raise NotImplementedError
+
+    def generation(self, user_id):
+        """Current generation of the user (read before the row that will be stored with set)."""
+        raise NotImplementedError
+
+    def set(self, user_id, state, generation):
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        """Drop the entry and start a new generation."""
+        raise NotImplementedError
+
+
+class LocalLRUCache(BaseSeedCache):
+    """Bounded LRU in process memory (a delete leaves a tombstone holding the new generation)."""
+
+    def __init__(self, max_size=SEED_CACHE_SIZE, ttl=SEED_CACHE_TTL):
+        self.max_size, self.ttl = max_size, ttl
+        self._entries = OrderedDict() #user id -> (expires, state or None, generation)
+        self._clock = 0 #last generation given
+        self._dropped = 0 #highest generation of the entries evicted or expired
+        self._lock = threading.Lock()
+
+    def _drop(self, user_id):
+        self._dropped = max(self._dropped, self._entries.pop(user_id)[2])
+
+    def _store(self, user_id, state, generation):
+        self._entries[user_id] = (time.monotonic() + self.ttl, state, generation)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._drop(user_id)
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def generation(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return entry[2] if entry is not None else self._clock
+
+    def set(self, user_id, state, generation):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            #Changed since generation(): tombstone/entry of another generation, or a tombstone already evicted
+            if (entry[2] if entry is not None else self._clock) != generation and (entry is not None or generation < self._dropped):
+                return
+            self._store(user_id, state, generation)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._clock += 1
+            self._store(user_id, None, self._clock)
+
+
+class FileCache(BaseSeedCache):
+    """One JSON file per user in a directory shared by the processes of the host (tmpfs: no disk I/O).
+
+    The generation of a user is a random token in a second file (<user id>.gen) written by delete();
+    an entry is only served if it was stored with the current token.
+    Files are spread in FILE_CACHE_BUCKETS sub directories. A stale file is deleted when it is read, and every
+    sweep_every writes one random sub directory is swept (at most sweep_max files checked), so the files of
+    users who don't come back don't pile up in memory.
+    """
+
+    def __init__(self, directory=SEED_CACHE_DIR, ttl=SEED_CACHE_TTL, sweep_every=SEED_CACHE_SWEEP_EVERY, sweep_max=SEED_CACHE_SWEEP_MAX):
+        self.directory, self.ttl = directory, ttl
+        self.sweep_every, self.sweep_max = sweep_every, sweep_max
+        self._writes = 0
+        for bucket in range(FILE_CACHE_BUCKETS):
+            os.makedirs(self._bucket(bucket), exist_ok=True)
+
+    def _bucket(self, bucket):
+        return os.path.join(self.directory, '%02x' % bucket)
+
+    def _path(self, user_id, extension='.json'):
+        return os.path.join(self._bucket(int(user_id) % FILE_CACHE_BUCKETS), str(int(user_id)) + extension)
+
+    def _read(self, path, expire=True):
+        """Content of a fresh file, None if missing or stale (stale files are deleted)."""
+        try:
+            if expire and os.stat(path).st_mtime + self.ttl < time.time():
+                os.remove(path)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, content):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(content, f)
+        os.replace(tmp, path) #atomic: readers never see a partial file
+        self._writes += 1
+        if self._writes % self.sweep_every == 0:
+            self.sweep(random.randrange(FILE_CACHE_BUCKETS))
+
+    def get(self, user_id):
+        entry = self._read(self._path(user_id))
+        if entry is None or entry.get('generation') != self.generation(user_id):
+            return None
+        return entry['state']
+
+    def generation(self, user_id):
+        #Not expired on read (a delete could be replacing it); old ones go with the sweep
+        return self._read(self._path(user_id, '.gen'), expire=False)
+
+    def set(self, user_id, state, generation):
+        self._write(self._path(user_id), {'generation': generation, 'state': state})
+
+    def delete(self, user_id):
+        self._write(self._path(user_id, '.gen'), secrets.token_hex(8))
+        try:
+            os.remove(self._path(user_id))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self, bucket):
+        """Delete the stale files (and temporary files of dead writers) of one sub directory, return how many."""
+        deadline = time.time() - self.ttl
+        deleted = 0
+        try:
+            with os.scandir(self._bucket(bucket)) as entries:
+                for checked, entry in enumerate(entries):
+                    if checked >= self.sweep_max:
+                        break
+                    try:
+                        if entry.stat().st_mtime < deadline:
+                            os.remove(entry.path)
+                            deleted += 1
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return deleted
+
+
+class DjangoCache(BaseSeedCache):
+    """Django cache framework (shared between hosts with Redis/memcached); generation: random token in a second key."""
+
+    def __init__(self, alias='default', ttl=SEED_CACHE_TTL):
+        from django.core.cache import caches
+        self.cache, self.ttl = caches[alias], ttl
+
+    def _key(self, user_id):
+        return 'seed_state:' + str(user_id)
+
+    def _generation_key(self, user_id):
+        return 'seed_state_gen:' + str(user_id)
+
+    def get(self, user_id):
+        values = self.cache.get_many([self._key(user_id), self._generation_key(user_id)])
+        entry = values.get(self._key(user_id))
+        if entry is None or entry['generation'] != values.get(self._generation_key(user_id)):
+            return None
+        return entry['state']
+
+    def generation(self, user_id):
+        return self.cache.get(self._generation_key(user_id))
+
+    def set(self, user_id, state, generation):
+        self.cache.set(self._key(user_id), {'generation': generation, 'state': state}, self.ttl)
+
+    def delete(self, user_id):
+        self.cache.set(self._generation_key(user_id), secrets.token_hex(8), self.ttl)
+        self.cache.delete(self._key(user_id))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_seed_cache():
+    """Process wide cache of the backend set in the settings."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = import_string(SEED_CACHE_BACKEND)()
+    return _cache
@@ -0,0 +1,106 @@
+"""
+Versioned encryption of the server seeds (utils/seed_keys.py).
+
+Stored value: 'v<version>$<ciphertext>'; values without prefix are version 1 (SEEDS_KEY, before the versions).
+Keys come from the environment: SEEDS_KEY (version 1), SEEDS_KEY_V2, SEEDS_KEY_V3...
+New values are encrypted with SEEDS_KEY_VERSION (default: the highest key) and reads accept every version,
+so a key rotation runs while the casino is live:
+    1. add SEEDS_KEY_V<n> (+ SEEDS_KEY_VERSION=n) and deploy: new seeds use the new key
+    2. python manage.py rotate_seed_keys: re-encrypts the stored seeds by chunks (resumable)
+    3. remove the old key once no row uses it (rotate_seed_keys --check)
+"""
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from django.db import transaction
+
+from utils import utils_encryption
+
+_PREFIX = re.compile(r'^v(\d+)\$')
+_KEY_NAME = re.compile(r'^SEEDS_KEY_V(\d+)$')
+
+
+@lru_cache(maxsize=None)
+def keys():
+    """{version: key} from the environment (read on first use, after the .env file is loaded)."""
+    found = {}
+    if os.environ.get('SEEDS_KEY'):
+        found[1] = os.environ['SEEDS_KEY']
+    for name, value in os.environ.items():
+        match = _KEY_NAME.match(name)
+        if match and value:
+            found[int(match.group(1))] = value
+    return found
+
+
+def current_version():
+    return int(os.environ.get('SEEDS_KEY_VERSION') or max(keys(), default=1))
+
+
+def _key(version, key_map):
+    try:
+        return key_map[version]
+    except KeyError:
+        raise ValueError('Unknown seed key version ' + str(version))
+
+
+def version_of(stored):
+    match = _PREFIX.match(stored)
+    return int(match.group(1)) if match else 1
+
+
+def encrypt(plain, version=None, key_map=None):
+    """Encrypt a server seed with the current key (or `version`)."""
+    version = version or current_version()
+    return 'v' + str(version) + '$' + utils_encryption.encrypt(plain, _key(version, key_map or keys()))
+
+
+def decrypt(stored, key_map=None):
+    """Decrypt a stored server seed, whatever its key version."""
+    match = _PREFIX.match(stored)
+    if match is None:
+        return utils_encryption.decrypt(stored, _key(1, key_map or keys()))
+    return utils_encryption.decrypt(stored[match.end():], _key(int(match.group(1)), key_map or keys()))
+
+
+def _reencrypt_chunk(task):
+    rows, version, key_map = task
+    return [(pk, encrypt(decrypt(stored, key_map), version, key_map)) for pk, stored in rows]
+
+
+def rotate(model, field, after_pk=0, version=None, chunk_size=1000, workers=None):
+    """Re-encrypt `field` of every row of `model` with the key `version`, by keyset chunks (pk order).
+
+    Each chunk is locked (select for update), re-encrypted by a process pool and written back with bulk_update.
+    Rows already at the version are skipped. Yields (last pk, rows updated) after each chunk: resume with after_pk.
+    """
+    version = version or current_version()
+    key_map = keys()
+    _key(version, key_map)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            with transaction.atomic():
+                #Locked so a seed changed meanwhile (modify_server_seed) is never overwritten with its old value
+                rows = list(model.objects.select_for_update().filter(pk__gt=after_pk).order_by('pk')
+                            .values_list('pk', field)[:chunk_size])
+                if not rows:
+                    return
+                stale = [(pk, stored) for pk, stored in rows if stored and version_of(stored) != version]
+                slices = [stale[start:start + 100] for start in range(0, len(stale), 100)]
+                updated = [pair for chunk in pool.map(_reencrypt_chunk, [(rows_slice, version, key_map) for rows_slice in slices])
+                           for pair in chunk]
+                model.objects.bulk_update([model(pk=pk, **{field: value}) for pk, value in updated], [field])
+            after_pk = rows[-1][0]
+            yield after_pk, len(updated)
+
+
+def count_by_version(model, field):
+    """{version: rows} of a model (to check that an old key is not used anymore)."""
+    counts = {}
+    for stored in model.objects.values_list(field, flat=True).iterator():
+        if stored:
+            version = version_of(stored)
+            counts[version] = counts.get(version, 0) + 1
+    return counts
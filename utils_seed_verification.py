@@ -0,0 +1,99 @@
+"""
+Bulk verification of revealed seeds (utils/seed_verification.py).
+
+Replays the rolls of a revealed server seed for a client seed & nonce range
+(chunk by chunk, with a process pool for large ranges) and compares them
+with the stored per-roll history (Game_Trx_historic of the flash bets made with that seed).
+Results are generated as dicts so they can be streamed (NDJSON) by the API and the verify_seeds command.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from core.models import Game_Trx_historic
+from utils import dice_rolls, utils_encryption
+
+CHUNK_SIZE = getattr(settings, 'VERIFY_CHUNK_SIZE', 50000) #rolls per chunk (one task of the pool / one streamed line)
+PARALLEL_THRESHOLD = getattr(settings, 'VERIFY_PARALLEL_THRESHOLD', 200000) #ranges smaller than this are rolled in process
+MAX_WORKERS = getattr(settings, 'VERIFY_MAX_WORKERS', os.cpu_count() or 1)
+
+
+def _roll_chunk(chunk):
+    server_seed, client_seed, nonce_start, count = chunk
+    return nonce_start, dice_rolls.roll_range(server_seed, client_seed, nonce_start, count)
+
+
+def iter_roll_chunks(server_seed, client_seed, nonce_start, count, workers=None):
+    """Yield (nonce_start, rolls) chunks in nonce order; rolls in hundredths (array('H')).
+
+    Large ranges are rolled by a process pool, with a bounded number of chunks
+    in flight so millions of rolls never sit in memory at once.
+    """
+    chunks = ((server_seed, client_seed, start, min(CHUNK_SIZE, nonce_start + count - start))
+              for start in range(nonce_start, nonce_start + count, CHUNK_SIZE))
+    workers = workers or MAX_WORKERS
+    if count < PARALLEL_THRESHOLD or workers <= 1:
+        for chunk in chunks:
+            yield _roll_chunk(chunk)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append(pool.submit(_roll_chunk, chunk))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def stored_rolls(user, hashed_server_seed, nonce_start, count):
+    """Stored rolls {nonce: roll} of a user for a seed (by its hash) in a nonce range."""
+    return dict(Game_Trx_historic.objects.filter(
+        user=user, flash_bet__hashed_server_seed=hashed_server_seed,
+        nonce__gte=nonce_start, nonce__lt=nonce_start + count,
+    ).values_list('nonce', 'rolled_dice'))
+
+
+def verify_seed(server_seed, client_seed, nonce_start, count, hashed_server_seed=None, user=None,
+                include_rolls=True, workers=None):
+    """Replay the rolls of one revealed seed; yields seed, chunk, mismatch and summary records.
+
+    - hashed_server_seed: hash shown to the user before the reveal, checked against the seed.
+    - user: compare with the stored history of this user (flash bets made with this seed).
+    """
+    seed_hash = utils_encryption.hash_input_SHA256(server_seed)
+    yield {
+        'type': 'seed',
+        'client_seed': client_seed,
+        'hashed_server_seed': seed_hash,
+        'hash_matches': None if hashed_server_seed is None else seed_hash == hashed_server_seed,
+        'nonce_start': nonce_start,
+        'count': count,
+    }
+
+    checked, mismatches = 0, 0
+    for chunk_start, rolls in iter_roll_chunks(server_seed, client_seed, nonce_start, count, workers):
+        if include_rolls:
+            yield {'type': 'chunk', 'nonce_start': chunk_start,
+                   'rolls': [str(dice_rolls.hundredths_to_roll(roll)) for roll in rolls]}
+        if user is None:
+            continue
+        for nonce, stored in sorted(stored_rolls(user, seed_hash, chunk_start, len(rolls)).items()):
+            expected = dice_rolls.hundredths_to_roll(rolls[nonce - chunk_start])
+            checked += 1
+            if stored != expected:
+                mismatches += 1
+                yield {'type': 'mismatch', 'nonce': nonce, 'expected': str(expected), 'stored': str(stored)}
+
+    yield {'type': 'summary', 'hashed_server_seed': seed_hash, 'rolls': count,
+           'checked': checked, 'mismatches': mismatches}
+
+
+def verify_seeds(specs, user=None, include_rolls=True, workers=None):
+    """Verify a batch of seeds, specs: dicts with server_seed, client_seed, nonce_start, count (and hashed_server_seed)."""
+    for spec in specs:
+        yield from verify_seed(spec['server_seed'], spec['client_seed'], int(spec.get('nonce_start', 0)),
+                               int(spec['count']), spec.get('hashed_server_seed'), user, include_rolls, workers)
@@ -0,0 +1,64 @@
+"""
+Pool of pre-generated deposit addresses (utils/wallet_pool.py).
+
+Free Wallet rows (user is null) of each chain are created in advance by the refill_wallet_pool
+command, so a signup only takes one of them (Wallet.assign: skip locked + one update).
+The addresses & encrypted keys come from the generator set by settings.WALLET_ADDRESS_GENERATOR
+(dotted path, chain specific key derivation).
+The free addresses left per chain are exported as the casino_wallet_pool_depth gauge
+(registered when this module is imported by the process serving /metrics).
+"""
+from django.conf import settings
+from django.db.models import Count
+from django.utils.module_loading import import_string
+
+from core.models import Wallet
+from utils import metrics
+
+WALLET_ADDRESS_GENERATOR = getattr(settings, 'WALLET_ADDRESS_GENERATOR', None)
+WALLET_POOL_CHAINS = getattr(settings, 'WALLET_POOL_CHAINS', ('ETH', 'BTC')) #chains with a deposit address pool
+WALLET_POOL_LOW_WATER = getattr(settings, 'WALLET_POOL_LOW_WATER', 1000) #refill below this many free addresses
+WALLET_POOL_TARGET = getattr(settings, 'WALLET_POOL_TARGET', 5000) #... up to this
+
+
+class BaseAddressGenerator:
+    """Interface of the address generators."""
+
+    def generate(self, blockchain, count):
+        """`count` new addresses of a chain: list of (public_key, encrypted private_key)."""
+        raise NotImplementedError
+
+
+def get_address_generator():
+    """Generator set in the settings."""
+    if not WALLET_ADDRESS_GENERATOR:
+        raise ValueError('WALLET_ADDRESS_GENERATOR is not set')
+    return import_string(WALLET_ADDRESS_GENERATOR)()
+
+
+def pool_depths():
+    """{blockchain: free addresses} (one aggregate query on the partial index of the free rows)."""
+    depths = dict.fromkeys(WALLET_POOL_CHAINS, 0)
+    depths.update(Wallet.objects.filter(user__isnull=True).values_list('blockchain').annotate(free=Count('id')))
+    return depths
+
+
+def refill(blockchain, low_water=None, target=None, batch_size=500, generator=None):
+    """Fill the free addresses of a chain up to `target` when below `low_water`; return the number added."""
+    low_water = WALLET_POOL_LOW_WATER if low_water is None else low_water
+    target = WALLET_POOL_TARGET if target is None else target
+    depth = Wallet.objects.filter(blockchain=blockchain, user__isnull=True).count()
+    if depth >= low_water:
+        return 0
+    generator = generator or get_address_generator()
+    missing = target - depth
+    for start in range(0, missing, batch_size):
+        Wallet.objects.bulk_create([
+            Wallet(public_key=public_key, private_key=private_key, blockchain=blockchain)
+            for public_key, private_key in generator.generate(blockchain, min(batch_size, missing - start))
+        ])
+    return missing
+
+
+metrics.register_gauges('casino_wallet_pool_depth', 'Free pre-generated deposit addresses by chain.',
+                        lambda: {(('blockchain', chain),): depth for chain, depth in pool_depths().items()})
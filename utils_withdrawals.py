@@ -0,0 +1,210 @@
+"""
+Batched processing of the withdrawals (utils/withdrawals.py).
+
+Pending User_Withdraw rows are grouped by chain & coin; a group is paid when it has a full batch
+(WITHDRAW_BATCH_SIZE outputs) or when its oldest withdrawal waited WITHDRAW_BATCH_WINDOW seconds:
+    1. debit: the members are locked (skip locked) and the users debited in one guarded UPDATE
+       (+ ledger entries); members the user can't afford fail right away, without debit
+    2. payout: one multi-output transaction for the whole batch, signed by the signer
+       set by settings.WITHDRAW_SIGNER (dotted path; FakeSigner for tests & dev)
+    3. members rejected by the signer (or the whole batch if nothing was sent) are refunded one by one
+
+A SignerError means nothing was sent. Any other error leaves the batch SIGNING (may have been broadcast):
+check it on chain before settling it by hand.
+"""
+import hashlib
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, F, Min, Q, Value, When
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+
+from core.models import BalanceLedger, Coin_Balance, Profile_User, User_Withdraw, Withdraw_Batch
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+WITHDRAW_SIGNER = getattr(settings, 'WITHDRAW_SIGNER', None) #dotted path of the signer class
+WITHDRAW_BATCH_SIZE = getattr(settings, 'WITHDRAW_BATCH_SIZE', 200) #outputs per payout transaction
+WITHDRAW_BATCH_WINDOW = getattr(settings, 'WITHDRAW_BATCH_WINDOW', 300) #seconds a withdrawal can wait for a full batch
+
+WITHDRAWALS = metrics.Counter('casino_withdrawals_total', 'Processed withdrawals by outcome.')
+
+
+class SignerError(Exception):
+    """The payout (or one of its outputs) was refused: nothing was sent."""
+
+
+class BaseSigner:
+    """Interface of the payout signers."""
+
+    def check_output(self, blockchain, coin_ticker, address, amount):
+        """SignerError if this output can't be paid (invalid address, dust...)."""
+
+    def send(self, blockchain, coin_ticker, outputs):
+        """Sign & broadcast one transaction paying every (address, amount) of outputs, return its hash."""
+        raise NotImplementedError
+
+
+class FakeSigner(BaseSigner):
+    """Local signer (tests & dev): nothing is broadcast, the hash is computed from the outputs.
+
+    Addresses starting with 'invalid' are refused; `fail` makes every send fail.
+    """
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.sent = []
+
+    def check_output(self, blockchain, coin_ticker, address, amount):
+        if address.startswith('invalid'):
+            raise SignerError('Invalid address ' + address)
+
+    def send(self, blockchain, coin_ticker, outputs):
+        if self.fail:
+            raise SignerError('Fake signer failure')
+        payload = blockchain + coin_ticker + ''.join(address + str(amount) for address, amount in outputs)
+        trx_hash = hashlib.sha256((payload + str(len(self.sent))).encode()).hexdigest()
+        self.sent.append((trx_hash, blockchain, coin_ticker, list(outputs)))
+        return trx_hash
+
+
+def get_signer():
+    """Signer set in the settings."""
+    if not WITHDRAW_SIGNER:
+        raise ValueError('WITHDRAW_SIGNER is not set')
+    return import_string(WITHDRAW_SIGNER)()
+
+
+def ready_groups(batch_size=WITHDRAW_BATCH_SIZE, window=WITHDRAW_BATCH_WINDOW):
+    """(blockchain, coin_ticker, batches) of the pending groups with a full batch or a withdrawal older than the window.
+
+    batches: number of full batches to send, None when the window is over (send everything pending).
+    """
+    deadline = now() - timedelta(seconds=window)
+    groups = (User_Withdraw.objects.filter(status=User_Withdraw.STATUS_PENDING)
+              .values('blockchain', 'coin_ticker').annotate(count=Count('id'), oldest=Min('withdraw_time')))
+    return [(group['blockchain'], group['coin_ticker'], None if group['oldest'] <= deadline else group['count'] // batch_size)
+            for group in groups if group['count'] >= batch_size or group['oldest'] <= deadline]
+
+
+def debit_batch(blockchain, coin_ticker, batch_size=WITHDRAW_BATCH_SIZE):
+    """Lock up to batch_size pending withdrawals of a group and debit them in one guarded update.
+
+    Returns (Withdraw_Batch, debited members), or (None, []) when nothing could be debited.
+    """
+    with transaction.atomic():
+        members = list(User_Withdraw.objects.select_for_update(skip_locked=True).filter(
+            status=User_Withdraw.STATUS_PENDING, blockchain=blockchain, coin_ticker=coin_ticker,
+        ).order_by('id')[:batch_size])
+        if not members:
+            return None, []
+        profiles = dict(Profile_User.objects.filter(user_id__in={member.user_id_id for member in members})
+                        .values_list('user_id', 'id'))
+        balances = Coin_Balance.objects.filter(owner_type=Coin_Balance.OWNER_PROFILE, coin_id=coin_ticker)
+        available = dict(balances.select_for_update().filter(owner_id__in=profiles.values()).values_list('owner_id', 'amount'))
+
+        #Oldest first: a user who can't afford all his withdrawals gets the first ones
+        debits = defaultdict(Decimal) #profile id -> total
+        accepted, refused = [], []
+        for member in members:
+            profile_id = profiles.get(member.user_id_id)
+            if profile_id is None or member.amount <= 0 or available.get(profile_id, 0) - debits[profile_id] < member.amount:
+                refused.append(member.pk)
+            else:
+                debits[profile_id] += member.amount
+                accepted.append(member)
+        if refused:
+            User_Withdraw.objects.filter(pk__in=refused).update(status=User_Withdraw.STATUS_FAILED, error='Not enough funds')
+            WITHDRAWALS.inc(len(refused), outcome='refused')
+        if not accepted:
+            return None, []
+
+        debits = {profile_id: total for profile_id, total in debits.items() if total}
+        guard = reduce(or_, [Q(owner_id=profile_id, amount__gte=total) for profile_id, total in debits.items()])
+        updated = balances.filter(guard).update(amount=F('amount') - Case(
+            *[When(owner_id=profile_id, then=Value(total)) for profile_id, total in debits.items()],
+            output_field=Coin_Balance._meta.get_field('amount')))
+        if updated != len(debits):
+            raise ValueError('Balances changed during the withdrawal batch') #rows are locked: should not happen
+        batch = Withdraw_Batch.objects.create(blockchain=blockchain, coin_ticker=coin_ticker,
+                                              total_amount=sum(member.amount for member in accepted))
+        BalanceLedger.objects.bulk_create([
+            BalanceLedger(user_id=member.user_id_id, coin_ticker=coin_ticker, delta=-member.amount,
+                          reason=BalanceLedger.REASON_WITHDRAW, reference=str(member.pk))
+            for member in accepted
+        ])
+        User_Withdraw.objects.filter(pk__in=[member.pk for member in accepted]).update(
+            status=User_Withdraw.STATUS_PROCESSING, batch=batch)
+    return batch, accepted
+
+
+def refund(member, error):
+    """Give back a debited withdrawal (once) and mark it failed."""
+    with transaction.atomic():
+        if not User_Withdraw.objects.filter(pk=member.pk, status=User_Withdraw.STATUS_PROCESSING).update(
+                status=User_Withdraw.STATUS_FAILED, error=str(error)):
+            return False
+        profile = Profile_User.objects.get(user_id=member.user_id_id)
+        profile.apply_delta(member.amount, member.coin_ticker, BalanceLedger.REASON_WITHDRAW, reference='refund ' + str(member.pk))
+    WITHDRAWALS.inc(outcome='refunded')
+    return True
+
+
+def pay_batch(batch, members, signer):
+    """Send the debited members in one payout; refund the ones that can't be sent."""
+    outputs = []
+    for member in members:
+        try:
+            signer.check_output(batch.blockchain, batch.coin_ticker, member.address, member.amount)
+            outputs.append(member)
+        except SignerError as e:
+            refund(member, e)
+
+    try:
+        if not outputs:
+            raise SignerError('No valid output')
+        with metrics.span('withdraw_sign'):
+            trx_hash = signer.send(batch.blockchain, batch.coin_ticker, [(member.address, member.amount) for member in outputs])
+    except SignerError as e:
+        logger.warning("Withdrawal batch %s not sent: %s", batch.pk, e)
+        for member in outputs:
+            refund(member, e)
+        Withdraw_Batch.objects.filter(pk=batch.pk).update(status=Withdraw_Batch.STATUS_FAILED, error=str(e))
+        return None
+
+    with transaction.atomic():
+        Withdraw_Batch.objects.filter(pk=batch.pk).update(
+            status=Withdraw_Batch.STATUS_SENT, trx_hash=trx_hash, sent_at=now(),
+            total_amount=sum(member.amount for member in outputs))
+        User_Withdraw.objects.filter(pk__in=[member.pk for member in outputs]).update(status=User_Withdraw.STATUS_SENT)
+    WITHDRAWALS.inc(len(outputs), outcome='sent')
+    return trx_hash
+
+
+def process_pending(signer, batch_size=WITHDRAW_BATCH_SIZE, window=WITHDRAW_BATCH_WINDOW):
+    """Pay every ready group, return the number of batches sent.
+
+    A group ready by size only sends its full batches (the rest waits for a full batch or the window),
+    a group past the window sends everything pending.
+    """
+    sent = 0
+    for blockchain, coin_ticker, batches in ready_groups(batch_size, window):
+        while batches is None or batches > 0:
+            if batches is not None:
+                batches -= 1
+            batch, members = debit_batch(blockchain, coin_ticker, batch_size)
+            if batch is None:
+                break
+            if pay_batch(batch, members, signer):
+                sent += 1
+            if len(members) < batch_size:
+                break
+    return sent
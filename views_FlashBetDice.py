@@ -4,13 +4,38 @@ from rest_framework.decorators import action
 from django.db import transaction
 
 from rest_framework.authentication import TokenAuthentication
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, AllowAny
+from django.http import HttpResponse, StreamingHttpResponse
 from flash_bets.serializers import FlashBetSerializer
 
 import time
+import json
+import logging
+from django.conf import settings
 
-from utils import flash_bets,provably_fair_dice,dice_setup
-from core.models import FlashBet,Profile_User,Casino_Bankroll,Seed
+from utils import flash_bets,dice_table,flash_bet_engine,flash_bet_jobs,metrics,pagination,idempotency
+from core.models import FlashBet,Casino_Bankroll,Seed,Dice_Custom_Strategies
+
+logger = logging.getLogger(__name__)
+
+FLASH_BET_STREAM_EVERY = getattr(settings, 'FLASH_BET_STREAM_EVERY', 1000) #Rolls between two progress events (streaming mode)
+FLASH_BET_STREAM_MIN_EVERY = 100
+FLASH_BET_STREAM_MAX_EVERY = getattr(settings, 'FLASH_BET_STREAM_MAX_EVERY', 10000) #Bound of ?every= (rolls per chunk: latency of one event)
+ROLLS_PAGE_SIZE = 100 #Default & max page sizes of the regenerated rolls of a flash bet
+ROLLS_MAX_PAGE_SIZE = 1000
+DICE_TABLE_MAX_AGE = 86400 #seconds, the table only changes with a new version
+STRATEGY_MAX_ROLLS = getattr(settings, 'STRATEGY_MAX_ROLLS', 100000) #Rolls of a strategy run (per roll summary in the response)
+
+class CompactFlashBetSerializer(FlashBetSerializer):
+    """Flash bet without the description (compact history listing)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields.pop('description', None)
+
+def _sse(event, data):
+    """One server-sent event."""
+    return 'event: ' + event + '\ndata: ' + json.dumps(data, default=str) + '\n\n'
 
 class FlashBetViewSet(viewsets.ModelViewSet):
     queryset = FlashBet.objects.all()
@@ -21,115 +46,304 @@ class FlashBetViewSet(viewsets.ModelViewSet):
     # a tokenauthentication type is required AND the user has to be authenticated; (error otherwise)
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
+    pagination_class = pagination.KeysetPagination #?cursor= & ?page_size=, on the (user, -id) index
 
 
     def get_queryset(self):
         """Retrieve trx flash hist for authenticated user."""
-        return self.queryset.filter(user=self.request.user).order_by('-id') # Filtered by user & ordered by id 
+        queryset = self.queryset.filter(user=self.request.user).order_by('-id') # Filtered by user & ordered by id 
+        if self.action == 'list':
+            queryset = pagination.filter_date_range(queryset, self.request.query_params)
+            if pagination.is_compact(self.request):
+                queryset = queryset.defer('description')
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action == 'list' and pagination.is_compact(self.request):
+            return CompactFlashBetSerializer
+        return self.serializer_class
     
+    @action(detail=False, methods=['get'], url_path='dice_table', authentication_classes=[], permission_classes=[AllowAny])
+    def dice_setup_table(self, request):
+        """Full table of the dice setups (payout_X, min_range, max_range for every winrate choice & direction).
+
+        Public & cacheable: the ETag is the version of the table.
+        """
+        etag = '"' + dice_table.VERSION + '"'
+        if request.headers.get('If-None-Match') == etag:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = HttpResponse(dice_table.TABLE_JSON, content_type='application/json')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'public, max-age=' + str(DICE_TABLE_MAX_AGE)
+        return response
+
     #@transaction.atomic
     @action(detail=False, methods=['post'], url_path='process')
     def process_flash_bet(self, request):
+        """Run a flash bet. With ?stream=1 the progress is sent as server-sent events every `every` rolls.
+
+        With an Idempotency-Key header (not in stream mode) a retry gets the stored response of the first request.
+        """
+        stream = str(request.query_params.get('stream', '')).lower() in ('1', 'true')
+        key = request.headers.get('Idempotency-Key')
+        if key is not None and not stream:
+            return idempotency.execute(request.user, key, request.data, lambda: self._process_flash_bet(request, stream))
+        return self._process_flash_bet(request, stream)
+
+    def _process_flash_bet(self, request, stream):
         serializer = FlashBetSerializer(data=request.data)
-        
-        
-        print("USER:",self.request.user , "BETTING ")
-        print()
-        
-        
-        st = time.time()
+        st = time.perf_counter()
         
         if serializer.is_valid():
-            user = request.user            
-            print(user)
             user = self.request.user
-            
-            print(user , "same:", request.user == self.request.user)
-            #Get data from user; Such as his profile with coin balances and Seed; 
-            res_profile = Profile_User.objects.filter(user_id=request.user).first()
-            res_seed = Seed.objects.filter(user_id=request.user).first()
-            casino_roll = Casino_Bankroll.objects.first() #Casino bankroll;
-            
-
-            #
-            number_of_bets = serializer.validated_data['number_of_bets']
-            bet_amount = serializer.validated_data["bet_amount"]
-            
-            #print("USER HERE:",user, request.user)
-            
-            
-            #>Compute the roll with provably fair script
-            #0) if bet is between 0.01 and 98% then proceed, else return response error ; => done in create method return custom response
-            #1) Verify if user already has a server_seed that is not visible yet, if yes use that one otherwise create a new one.
-            #2) Perform rolls on the combination of the client_seed & server_seed (and nonce) 
-            #3) Compute dice params based on user inputs from request 
-            #4) Compare rolls results and check if win or lose
-            if res_seed.visible:
-                pfair = provably_fair_dice.ProvablyFair() #use constructor that automatically generates new seed;
-                res_seed.modify_server_seed(pfair.server_seed)
-            else:
-                pfair = provably_fair_dice.ProvablyFair(res_seed.server_seed)
-
-            print("SEEDS", res_seed.client_seed, res_seed.server_seed)            
-            #Compute the dice setup (payouts and min max ranges for the dice - for current bet)
-
-            dice_params_current_bet = dice_setup.compute_dice_setup(serializer.validated_data["user_winrate_choice"], 
-                                                                        serializer.validated_data["is_roll_under"])
-                
-            won_amount_after_fee = (serializer.validated_data["bet_amount"] * dice_params_current_bet.payout_X ) - serializer.validated_data["bet_amount"]#Value for Adding funds according in case user wins;
-                
-            winnings, losses = 0, 0
-            net_profit=0
-            for index_bet in range(number_of_bets):
-                #Provably fair script;
-                rolled_data = pfair.roll(res_seed.client_seed, res_seed.nonce)
-                #print("ROLLED DATA TRX:",rolled_data.roll)
+
+            #Big flash bets run in background: return the job id (status: flash_bets/jobs/<id>)
+            if not stream and serializer.validated_data['number_of_bets'] > flash_bet_jobs.FLASH_BET_JOB_THRESHOLD:
                 try:
-                    #Win bet if rolled dice from provably fair in within computed ranges
-                    if dice_params_current_bet.min_range <= rolled_data.roll < dice_params_current_bet.max_range:
-                        net_profit+=won_amount_after_fee #The user won the bet; so he gets a profit, with a reduction coming from fee
-                        winnings+=1
-                    else: #else lose and reduce funds from user
-                        losses+=1
-                        net_profit-= serializer.validated_data["bet_amount"] 
-                except ValueError as e :
-                    print("Error:",e)
-                    if net_profit>0:
-                        res_profile.gain_funds(amount =net_profit, coin_ticker = serializer.validated_data["coin_ticker"], casino_ref = casino_roll )
-                    else:
-                        res_profile.reduce_funds_bet( amount = -net_profit , coin_ticker = serializer.validated_data["coin_ticker"], casino_ref = casino_roll )
+                    dice_table.get_dice_setup(serializer.validated_data["user_winrate_choice"], 
+                                              serializer.validated_data["is_roll_under"])
+                    job_id = flash_bet_jobs.get_job_queue().enqueue(user, serializer.validated_data)
+                except ValueError as e:
+                    metrics.FLASH_BET_ERRORS.inc(reason='invalid_dice')
                     return Response({
                         'status': 'error',
-                        'message': 'Insufficient funds, stopped at the bet number: '+str(index_bet),
-                        
-                        'winnings': winnings,
-                        'losses': losses,
-                        
-                        'net_profit':net_profit,
-                        'coin_ticker':serializer.validated_data["coin_ticker"],
-                        
+                        'message': str(e),
                     }, status=status.HTTP_400_BAD_REQUEST)
-                #update user nonce for next bet with the same seed:
-                res_seed.increment_nonce()
-            
-
-            # get the end time
-            et = time.time()
-            # get the execution time
-            elapsed_time = et - st
-            print('Execution time:', elapsed_time, 'seconds')
-            # Save the FlashBet instance after processing all bets
-            #flash_bet = FlashBet(user=self.request.user, number_of_bets=number_of_bets, bet_amount=bet_amount)
-            #flash_bet.save()
-            serializer.save(user=user, number_of_bets=number_of_bets, bet_amount=bet_amount)
-            return Response({
-                'status': 'success',
-                'winnings': winnings,
-                'losses': losses,
-                'net_profit':net_profit,
-                'coin_ticker':serializer.validated_data["coin_ticker"],
-                'time_run':elapsed_time
-            }, status=status.HTTP_200_OK)
+                except flash_bet_jobs.JobQueueFull as e:
+                    metrics.FLASH_BET_ERRORS.inc(reason='queue_full')
+                    return Response({
+                        'status': 'error',
+                        'message': str(e),
+                    }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+                return Response({
+                    'status': 'queued',
+                    'job_id': job_id,
+                }, status=status.HTTP_202_ACCEPTED)
+
+            #Seed & profile rows stay locked until the nonces are reserved (seed rotation can't interleave)
+            with transaction.atomic():
+                #Get data from user; his profile with coin balances and Seed in one query (locked), cached casino bankroll;
+                with metrics.span('seed_load'):
+                    res_seed = Seed.load_for_user(user, lock=True)
+                    res_profile = res_seed.user.profile_user if res_seed is not None else None
+                    casino_roll = Casino_Bankroll.get_cached()
+
+                #>Compute the roll with provably fair script
+                #0) if bet is between 0.01 and 98% then proceed, else return response error (dice table lookup)
+                #1) Verify if user already has a server_seed that is not visible yet, if yes use that one otherwise create a new one.
+                #2) Perform rolls on the combination of the client_seed & server_seed (and nonce) 
+                #3) Compute dice params based on user inputs from request 
+                #4) Compare rolls results and check if win or lose
+                try:
+                    engine = flash_bet_engine.FlashBetEngine(user, serializer.validated_data, res_profile, res_seed, casino_roll)
+                except ValueError as e:
+                    metrics.FLASH_BET_ERRORS.inc(reason='invalid_dice')
+                    return Response({
+                        'status': 'error',
+                        'message': str(e),
+                    }, status=status.HTTP_400_BAD_REQUEST)
+
+                #Claim the nonces of the whole flash bet at once (single UPDATE on the seed row)
+                try:
+                    engine.start()
+                except ValueError as e:
+                    metrics.FLASH_BET_ERRORS.inc(reason='seed_changed')
+                    return Response({
+                        'status': 'error',
+                        'message': str(e),
+                    }, status=status.HTTP_409_CONFLICT)
+
+
+            if stream:
+                try:
+                    every = min(FLASH_BET_STREAM_MAX_EVERY,
+                                max(FLASH_BET_STREAM_MIN_EVERY, int(request.query_params.get('every', FLASH_BET_STREAM_EVERY))))
+                except ValueError:
+                    every = FLASH_BET_STREAM_EVERY
+                return self._stream_flash_bet(engine, every)
+
+            try:
+                #Roll every bet in one batch (nonces nonce_start -> nonce_start+number_of_bets-1) and tally wins against the dice ranges,
+                #stopping at the first bet the user can't afford (only the rolls done are settled)
+                engine.roll(engine.number_of_bets, engine.balance())
+
+                # Save the FlashBet instance after processing all bets and settle the net profit once (guarded update + ledger entry)
+                try:
+                    engine.settle()
+                except ValueError as e:
+                    logger.info("Flash bet refused: %s", e)
+                    metrics.FLASH_BET_ERRORS.inc(reason='insufficient_funds')
+                    return Response({
+                        'status': 'error',
+                        'message': 'Insufficient funds for this flash bet',
+                    
+                        'winnings': engine.winnings,
+                        'losses': engine.losses,
+                    
+                        'net_profit':engine.net_profit,
+                        'coin_ticker':engine.coin_ticker,
+                    
+                    }, status=status.HTTP_400_BAD_REQUEST)
+
+                # get the execution time
+                elapsed_time = time.perf_counter() - st
+                metrics.FLASH_BET_LATENCY.observe(elapsed_time, coin=engine.coin_ticker)
+                return Response({
+                    'status': 'stopped' if engine.out_of_funds else 'success',
+                    'message': 'Insufficient funds, stopped at the bet number: ' + str(engine.rolls_done) if engine.out_of_funds else '',
+                    'rolls_done': engine.rolls_done,
+                    'winnings': engine.winnings,
+                    'losses': engine.losses,
+                    'net_profit':engine.net_profit,
+                    'coin_ticker':engine.coin_ticker,
+                    'time_run':elapsed_time
+                }, status=status.HTTP_200_OK)
+            finally:
+                engine.release() #the seed can be revealed / changed again
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def _stream_flash_bet(self, engine, every):
+        """Server-sent events: 'progress' every `every` rolls, then 'done' (or 'error').
+
+        Stops early when the user can't afford the next bet; if the client disconnects
+        the rolls already done are settled (partial flash bet).
+        """
+        balance = engine.balance()
+
+        def events():
+            failed = False
+            try:
+                while engine.rolls_done < engine.number_of_bets and not engine.out_of_funds:
+                    engine.roll(every, balance)
+                    yield _sse('progress', engine.progress())
+                engine.settle()
+                engine.release() #before 'done': the client may reveal its seed right after
+                yield _sse('done', {
+                    'status': 'stopped' if engine.out_of_funds else 'success',
+                    'message': 'Insufficient funds, stopped at the bet number: ' + str(engine.rolls_done) if engine.out_of_funds else '',
+                    **engine.progress(),
+                })
+            except ValueError as e:
+                failed = True
+                logger.info("Flash bet stream stopped: %s", e)
+                metrics.FLASH_BET_ERRORS.inc(reason='insufficient_funds')
+                yield _sse('error', {'status': 'error', 'message': str(e), **engine.progress()})
+            finally:
+                #Client gone (generator closed before the end): settle what was rolled
+                if engine.flash_bet is None and not failed:
+                    try:
+                        engine.settle()
+                    except ValueError as e:
+                        logger.warning("Partial flash bet not settled: %s", e)
+                engine.release()
+
+        response = StreamingHttpResponse(events(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no' #no proxy buffering of the events
+        return response
+
+    @action(detail=False, methods=['post'], url_path=r'strategies/(?P<strategy_id>[0-9]+)/run')
+    def run_strategy(self, request, strategy_id=None):
+        """Run a saved dice strategy server side in one batch (optional body: number_of_rolls).
+
+        The rolls stop at number_of_rolls, stop loss, take profit or when the user can't afford the next bet;
+        the net profit is settled once (one FlashBet) and every roll is returned: [nonce, roll, bet_amount, is_winner, net_profit].
+        """
+        strategy = Dice_Custom_Strategies.objects.filter(user=request.user, pk=int(strategy_id)).first()
+        if strategy is None:
+            return Response({'status': 'error', 'message': 'Unknown strategy'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            number_of_rolls = int(request.data.get('number_of_rolls', strategy.number_of_rolls))
+        except (TypeError, ValueError):
+            number_of_rolls = -1
+        if not 0 < number_of_rolls <= STRATEGY_MAX_ROLLS:
+            return Response({
+                'status': 'error',
+                'message': 'Invalid number of rolls (max ' + str(STRATEGY_MAX_ROLLS) + ')',
+            }, status=status.HTTP_400_BAD_REQUEST)
+        st = time.perf_counter()
+
+        with transaction.atomic():
+            with metrics.span('seed_load'):
+                res_seed = Seed.load_for_user(request.user, lock=True)
+                res_profile = res_seed.user.profile_user if res_seed is not None else None
+            try:
+                engine = flash_bet_engine.StrategyEngine(request.user, strategy, res_profile, res_seed,
+                                                         Casino_Bankroll.get_cached(), number_of_rolls)
+            except ValueError as e:
+                metrics.FLASH_BET_ERRORS.inc(reason='invalid_dice')
+                return Response({'status': 'error', 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                engine.start()
+            except ValueError as e:
+                metrics.FLASH_BET_ERRORS.inc(reason='seed_changed')
+                return Response({'status': 'error', 'message': str(e)}, status=status.HTTP_409_CONFLICT)
+
+        try:
+            engine.run(engine.balance())
+            flash_bet = engine.settle()
+        except ValueError as e:
+            logger.info("Strategy run refused: %s", e)
+            metrics.FLASH_BET_ERRORS.inc(reason='insufficient_funds')
+            return Response({
+                'status': 'error',
+                'message': 'Insufficient funds for this strategy',
+                **engine.progress(),
+            }, status=status.HTTP_400_BAD_REQUEST)
+        finally:
+            engine.release()
+
+        elapsed_time = time.perf_counter() - st
+        metrics.FLASH_BET_LATENCY.observe(elapsed_time, coin=engine.coin_ticker)
+        return Response({
+            'status': 'success',
+            'flash_bet': flash_bet.pk,
+            **engine.progress(),
+            'rolls': engine.summary(),
+            'time_run': elapsed_time,
+        }, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], url_path=r'jobs/(?P<job_id>[0-9]+)')
+    def job_status(self, request, job_id=None):
+        """Status of a background flash bet, with its result (winnings, losses, net_profit...) once done."""
+        job = flash_bet_jobs.get_job_queue().get(request.user, int(job_id))
+        if job is None:
+            return Response({'status': 'error', 'message': 'Unknown job'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({
+            'job_id': job.pk,
+            'status': job.status,
+            'result': job.result,
+            'error': job.error,
+            'flash_bet': job.flash_bet_id,
+            'created_at': job.created_at,
+            'started_at': job.started_at,
+            'finished_at': job.finished_at,
+        }, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['get'], url_path='rolls')
+    def rolls(self, request, pk=None):
+        """Paginated rolls of a flash bet, regenerated from its seeds & nonce range (?page=0&page_size=100)."""
+        flash_bet = self.get_object()
+        try:
+            page = int(request.query_params.get('page', 0))
+            page_size = int(request.query_params.get('page_size', ROLLS_PAGE_SIZE))
+        except ValueError:
+            return Response({'status': 'error', 'message': 'Invalid page'}, status=status.HTTP_400_BAD_REQUEST)
+        if page < 0 or not 0 < page_size <= ROLLS_MAX_PAGE_SIZE:
+            return Response({'status': 'error', 'message': 'Invalid page'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            results = flash_bet.expand_rolls(page, page_size)
+        except ValueError as e:
+            return Response({'status': 'error', 'message': str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response({
+            'count': flash_bet.number_of_bets,
+            'page': page,
+            'page_size': page_size,
+            'next': page + 1 if (page + 1) * page_size < flash_bet.number_of_bets else None,
+            'hashed_server_seed': flash_bet.hashed_server_seed,
+            'client_seed': flash_bet.client_seed,
+            'results': [{'nonce': nonce, 'roll': roll, 'is_winner': is_winner} for nonce, roll, is_winner in results],
+        }, status=status.HTTP_200_OK)
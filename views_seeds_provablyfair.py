@@ -16,6 +16,21 @@ from rest_framework.permissions import IsAuthenticated
 from core.models import Seed#_BaseModel
 from seeds import serializers
 from django.db import transaction
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from utils import seed_verification, pagination
+import json
+
+VERIFY_MAX_ROLLS_REQUEST = getattr(settings, 'VERIFY_MAX_ROLLS_REQUEST', 200000) #Rolled in the web worker; bigger audits: verify_seeds command
+
+
+def _flash_bet_in_flight_response():
+    """Refusal of the seed reveal / change while a flash bet of the seed is not settled (its rolls would be known before)."""
+    return Response({
+        'status': 'error',
+        'message': 'A flash bet is in progress, try again once it is settled',
+    }, status=status.HTTP_409_CONFLICT)
+
 
 class Seed_ViewSet(viewsets.ModelViewSet): #=> modelviewset for specific model; (opposite of standard view set )
     """View for manage wallets APIs. (expand this doc string for the swagger docs)"""
@@ -26,13 +41,14 @@ class Seed_ViewSet(viewsets.ModelViewSet): #=> modelviewset for specific model;
     # a tokenauthentication type is required AND the user has to be authenticated; (error otherwise)
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
+    pagination_class = pagination.KeysetPagination
 
 
     def get_allowed_methods(self):
         """
         Return the list of allowed HTTP methods for this view
         """
-        allowed_methods = ['get', 'put']
+        allowed_methods = ['get', 'put', 'post']
         return [method.upper() for method in allowed_methods]
 
     def create(self, request, *args, **kwargs):
@@ -55,17 +71,24 @@ class Seed_ViewSet(viewsets.ModelViewSet): #=> modelviewset for specific model;
         return self.serializer_class
     
     
+    @action(detail=False, methods=['get'], url_path='state')
+    def state(self, request):
+        """Public seed state (hashed server seed, client seed, nonce, visible) for polling: served from the seed cache."""
+        state = Seed.public_state(request.user.id)
+        if state is None:
+            return Response({'status': 'error', 'message': 'No seed'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(state, status=status.HTTP_200_OK)
+
     @action(detail=False, methods=['get'], url_path='reveal_server_seed')
     def reveal_server_seed(self, request):
         #serializer = serializers.ServerSeedSerializer(data=request.data)
         #serializer.is_valid(raise_exception=True)  
         try:
             with transaction.atomic():
-                print( )
-                seed_user = Seed.objects.filter(user_id=request.user).first()
-                hashed = seed_user.hash_server_seed()
-                print("HASHED",hashed)
-                original_server_seed = seed_user.reveal_server_seed()
+                seed_user = Seed.load_for_user(request.user, lock=True)
+                if seed_user.flash_bet_in_flight():
+                    return _flash_bet_in_flight_response()
+                original_server_seed = seed_user.reveal_server_seed() #only decryption of this endpoint
                 
         except Exception as e:
             print("Error reveal: ",e)
@@ -79,12 +102,50 @@ class Seed_ViewSet(viewsets.ModelViewSet): #=> modelviewset for specific model;
             'status': 'success',
             'message': 'Server seed modified.',
             'server_seed':original_server_seed,
-            'hashed_server_seed': seed_user.hash_server_seed(),
+            'hashed_server_seed': seed_user.hash_server_seed(), #stored hash, no decryption
             
         }, status=status.HTTP_200_OK)
         
     
     
+    @action(detail=False, methods=['post'], url_path='verify')
+    def verify(self, request):
+        """Replay the rolls of revealed seed(s) and compare them with the stored history of the user.
+
+        Body: {server_seed, client_seed, nonce_start, count, hashed_server_seed (optional)}
+        or {"seeds": [...same objects...]}, and "include_rolls" (default true).
+        Streamed as NDJSON: seed / chunk / mismatch / summary lines.
+        """
+        specs = request.data.get('seeds', [request.data])
+        try:
+            specs = [{
+                'server_seed': str(spec['server_seed']),
+                'client_seed': str(spec['client_seed']),
+                'nonce_start': int(spec.get('nonce_start', 0)),
+                'count': int(spec['count']),
+                'hashed_server_seed': spec.get('hashed_server_seed'),
+            } for spec in specs]
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return Response({
+                'status': 'error',
+                'message': 'server_seed, client_seed and count are required for each seed',
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        total = sum(spec['count'] for spec in specs)
+        if any(spec['count'] < 0 or spec['nonce_start'] < 0 for spec in specs) or total > VERIFY_MAX_ROLLS_REQUEST:
+            return Response({
+                'status': 'error',
+                'message': 'Invalid nonce range (max ' + str(VERIFY_MAX_ROLLS_REQUEST) + ' rolls per request)',
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        include_rolls = str(request.data.get('include_rolls', True)).lower() not in ('false', '0')
+        #workers=1: rolled in process, the process pool is only for the verify_seeds command
+        records = seed_verification.verify_seeds(specs, user=request.user, include_rolls=include_rolls, workers=1)
+        return StreamingHttpResponse((json.dumps(record) + '\n' for record in records),
+                                     content_type='application/x-ndjson')
+
+
+
     @action(detail=False, methods=['put'], url_path='change_server_seed')
     def change_server_seed(self, request):
         serializer = serializers.ServerSeedSerializer(data=request.data)
@@ -92,7 +153,9 @@ class Seed_ViewSet(viewsets.ModelViewSet): #=> modelviewset for specific model;
         
         try:
             with transaction.atomic():
-                seed_user = Seed.objects.filter(user_id=request.user).first()
+                seed_user = Seed.load_for_user(request.user, lock=True)
+                if seed_user.flash_bet_in_flight():
+                    return _flash_bet_in_flight_response()
                 seed_user.modify_server_seed()
             
         except Exception as e:
@@ -151,5 +214,6 @@ class Seed_ViewSet(viewsets.ModelViewSet): #=> modelviewset for specific model;
         #print(str(instance), instance)
         #self.perform_update(serializer)
         instance.save()
+        instance.invalidate_public_state()
 
         return Response(serializer.data)